@@ -1,10 +1,13 @@
+import io
 import os
+import json
+import hmac
 import uuid
+import hashlib
 import traceback
 from datetime import datetime, timedelta
-from pathlib import Path, PurePath
 
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, stream_with_context
 from flask_migrate import Migrate
 from flask_jwt_extended import (
     JWTManager,
@@ -16,35 +19,133 @@ from flask_jwt_extended import (
     get_jwt,
 )
 from flask_cors import CORS
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import delete, func, or_, select, tuple_
+from sqlalchemy.orm import contains_eager, joinedload
+from werkzeug.http import parse_content_range_header, quote_etag
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flasgger import Swagger, swag_from
-from google import genai
-from google.genai import types
 
-from models import db, User, Profile, Rom, Save
+from models import (
+    db,
+    User,
+    Profile,
+    Rom,
+    RomBlob,
+    Save,
+    UploadSession,
+    IngestJob,
+    Conversation,
+)
 from config import Config
-from validators import validate_password
+from validators import validate_password, validate_file_entry, validate_rom_entry
 from utils import (
     allowed_file,
     create_user_directories,
     get_file_size,
-    save_file_streaming,
-    stream_file_response,
-    calculate_hash_and_save_streaming,
+    storage_file_response,
+    bytes_response,
+    calculate_file_hash,
+    blob_relative_path,
+    schedule_blob_compression,
+    remove_blob,
+    upload_part_path,
+    receive_upload_chunk,
+    write_upload_chunk,
+    finish_upload_hash,
+    discard_upload,
+    encode_cursor,
+    decode_cursor,
+    parse_byte_ranges,
+    if_range_matches,
+)
+from storage import blob_storage, user_storage
+from save_versions import load_save_data, store_save_version
+from ingest import (
+    import_rom_archive,
+    insert_rom_blobs,
+    ingest_roms,
+    ingest_saves,
+    start_ingest_job,
+)
+from rom_metadata import read_rom_metadata, scan_rom
+from ownership import issue_challenge, verify_proof
+from backfill import backfill_rom_blobs
+from archive import build_stored_zip, iter_zip_range
+from assistant import (
+    acquire_slot,
+    release_slot,
+    generate_reply,
+    stream_reply,
+    conversation_contents,
+    message_content,
+    add_message,
+    expire_conversations,
+    trim_contents,
+    reply_cache,
+    reply_cache_key,
+    sse_event,
+)
+from export import build_library_export, export_etag
+from runtime import run_blocking
+from quota import (
+    QuotaExceededError,
+    check_storage,
+    release_storage,
+    reserve_storage,
+    storage_used,
 )
+from ratelimit import rate_limit
+from passwords import hash_password, verify_password
+from database import engine_options, use_replica
+from metrics import init_metrics, register_cache, render_metrics
+from rom_cache import rom_cache
 
 app = Flask(__name__)
 app.config.from_object(Config)
+if app.config["PROXY_COUNT"]:
+    app.wsgi_app = ProxyFix(
+        app.wsgi_app, x_for=app.config["PROXY_COUNT"], x_proto=app.config["PROXY_COUNT"]
+    )
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+    app.config["SQLALCHEMY_DATABASE_URI"]
+)
 
 db.init_app(app)
 migrate = Migrate(app, db)
 jwt = JWTManager(app)
 swagger = Swagger(app)
-client = genai.Client(api_key=app.config["GEMINI_API_KEY"])
 CORS(app, supports_credentials=True)
+init_metrics(app)
+register_cache("roms", rom_cache)
+register_cache("assistant", reply_cache)
 
 with app.app_context():
     os.makedirs(app.config["ROM_FOLDER"], exist_ok=True)
+    os.makedirs(app.config["BLOB_FOLDER"], exist_ok=True)
+
+
+@app.cli.command("backfill-blobs")
+def backfill_blobs():
+    """
+    Migra al almacén de blobs las ROMs subidas antes de que existiera.
+    """
+    migrated, lost = backfill_rom_blobs()
+    print(f"ROMs migradas: {migrated}, sin fichero: {lost}")
+
+
+def create_user_token(username, user_id):
+    # El id viaja en el token para no consultar la base de datos en cada petición
+    return create_access_token(identity=username, additional_claims={"uid": user_id})
+
+
+def current_user_id():
+    user_id = get_jwt().get("uid")
+    if user_id is None:
+        # Tokens emitidos antes de incluir el id del usuario
+        user_id = (
+            db.session.query(User.id).filter_by(username=get_jwt_identity()).scalar()
+        )
+    return user_id
 
 
 @app.after_request
@@ -57,14 +158,25 @@ def refresh_jwt(response):
         now = datetime.now()
         refresh_timestamp = datetime.timestamp(now + timedelta(minutes=30))
         if refresh_timestamp > exp_timestamp_jwt:
-            access_token = create_access_token(identity=get_jwt_identity())
+            access_token = create_user_token(get_jwt_identity(), current_user_id())
             set_access_cookies(response, access_token)
         return response
     except (RuntimeError, KeyError):
         return response
 
 
+def quota_exceeded(error):
+    return jsonify(
+        {
+            "error": str(error),
+            "storage_used": error.used,
+            "storage_quota": error.quota,
+        }
+    ), 413
+
+
 @app.route("/gemini", methods=["POST"])
+@rate_limit("assistant")
 def gemini():
     data = request.get_json()
     content = data.get("content")
@@ -83,19 +195,128 @@ def gemini():
 
     contents.append({"role": "user", "parts": [{"text": content}]})
 
-    try:
-        response = client.models.generate_content(
-            model="gemini-2.0-flash",
-            config=types.GenerateContentConfig(
-                system_instruction="Eres un señor mayor que le gustan los videojuegos y entiendes mucho sobre ellos"
-            ),
-            contents=contents,
+    cache_key = reply_cache_key(contents)
+    cached = reply_cache.get(cache_key)
+    if cached is not None:
+        return jsonify({"response": cached}), 200, {"X-Cache": "HIT"}
+
+    if not acquire_slot():
+        return (
+            jsonify({"error": "El asistente está ocupado"}),
+            503,
+            {"Retry-After": "5"},
         )
 
-        return jsonify({"response": response.text})
+    try:
+        reply = generate_reply(trim_contents(contents))
+        reply_cache.put(cache_key, reply)
+        return jsonify({"response": reply}), 200, {"X-Cache": "MISS"}
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    finally:
+        release_slot()
+
+
+@app.route("/gemini/stream", methods=["POST"])
+@rate_limit("assistant")
+@swag_from("docs/geministream.yml")
+def geministream():
+    data = request.get_json(silent=True) or {}
+    content = (data.get("content") or "").strip()
+    conversation_id = data.get("conversation_id")
+
+    if not content:
+        return jsonify({"error": "El mensaje está vacío"}), 400
+
+    # La conversación se guarda en el servidor, el cliente solo envía el
+    # mensaje nuevo y el identificador que recibió en el primer evento
+    if conversation_id and not db.session.get(Conversation, conversation_id):
+        return jsonify({"error": "Conversación no encontrada"}), 404
+
+    contents = conversation_contents(conversation_id) if conversation_id else []
+    contents.append(message_content("user", content))
+
+    # Una respuesta en caché no ocupa hueco del modelo
+    cache_key = reply_cache_key(contents)
+    cached = reply_cache.get(cache_key)
+    if cached is None and not acquire_slot():
+        return (
+            jsonify({"error": "El asistente está ocupado"}),
+            503,
+            {"Retry-After": "5"},
+        )
+
+    try:
+        if not conversation_id:
+            expire_conversations()
+            conversation_id = uuid.uuid4().hex
+            db.session.add(Conversation(id=conversation_id))
+            db.session.flush()
+        add_message(conversation_id, "user", content)
+        db.session.commit()
+    except Exception:
+        traceback.print_exc()
+        db.session.rollback()
+        if cached is None:
+            release_slot()
+        return jsonify({"error": "Error al guardar el mensaje"}), 500
+
+    slot_held = cached is None
+
+    def release():
+        # Se llama al terminar el generador y al cerrar la respuesta, que
+        # ocurre aunque el cliente se desconecte antes de empezar a leerla
+        nonlocal slot_held
+        if slot_held:
+            slot_held = False
+            release_slot()
+
+    def generate():
+        parts = []
+        stored = False
+        try:
+            yield sse_event("conversation", {"conversation_id": conversation_id})
+            if cached is not None:
+                replies = [cached]
+            else:
+                replies = stream_reply(trim_contents(contents))
+            for text in replies:
+                parts.append(text)
+                yield sse_event("message", {"text": text})
+            reply = "".join(parts)
+            add_message(conversation_id, "model", reply)
+            db.session.commit()
+            stored = True
+            if cached is None:
+                reply_cache.put(cache_key, reply)
+            yield sse_event("done", {})
+        except Exception as e:
+            traceback.print_exc()
+            db.session.rollback()
+            yield sse_event("error", {"error": str(e)})
+        finally:
+            # Si el cliente se desconecta se guarda lo que llegó a generarse
+            if not stored and parts:
+                try:
+                    add_message(conversation_id, "model", "".join(parts))
+                    db.session.commit()
+                except Exception:
+                    traceback.print_exc()
+                    db.session.rollback()
+            release()
+
+    response = app.response_class(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            "X-Cache": "MISS" if cached is None else "HIT",
+        },
+    )
+    response.call_on_close(release)
+    return response
 
 
 @app.route("/api/register", methods=["POST"])
@@ -116,7 +337,7 @@ def register():
         return jsonify({"error": password_error}), 400
 
     try:
-        hashed_password = generate_password_hash(password)
+        hashed_password = hash_password(password)
         new_user = User(username=username, password=hashed_password)
         db.session.add(new_user)
         db.session.flush()
@@ -126,7 +347,7 @@ def register():
         db.session.commit()
 
         create_user_directories(new_user.id)
-        access_token = create_access_token(identity=new_user.username)
+        access_token = create_user_token(new_user.username, new_user.id)
         response = jsonify({"msg": "Usuario registrado"})
         set_access_cookies(response, access_token)
         return response, 201
@@ -142,10 +363,27 @@ def login():
     user = User.query.filter_by(username=data.get("username")).first()
     password = data.get("password")
 
-    if not user or not check_password_hash(user.password, password):
+    if not password:
+        # Se verifica igualmente contra el hash ficticio para que la respuesta
+        # tarde lo mismo que con una contraseña incorrecta
+        verify_password(None, "")
+        return jsonify({"error": "Credenciales incorrectas"}), 401
+
+    valid, new_hash = verify_password(user.password if user else None, password)
+    if not valid:
         return jsonify({"error": "Credenciales incorrectas"}), 401
 
-    access_token = create_access_token(identity=user.username)
+    # El hash guardado usa otro esquema o parámetros: se actualiza ahora que se
+    # conoce la contraseña. Si falla, se reintentará en el próximo inicio
+    if new_hash:
+        try:
+            user.password = new_hash
+            db.session.commit()
+        except Exception:
+            traceback.print_exc()
+            db.session.rollback()
+
+    access_token = create_user_token(user.username, user.id)
     response = jsonify({"msg": "Login exitoso"})
     set_access_cookies(response, access_token)
     return response, 200
@@ -169,11 +407,15 @@ def user():
 
 @app.route("/api/profile", methods=["GET"])
 @jwt_required()
+@use_replica
 @swag_from("docs/profile.yml")
 def profile():
     try:
-        username = get_jwt_identity()
-        user = User.query.filter_by(username=username).first()
+        user = (
+            User.query.options(joinedload(User.profile))
+            .filter_by(id=current_user_id())
+            .first()
+        )
 
         if not user:
             return jsonify({"success": False, "message": "Usuario no encontrado"}), 404
@@ -186,11 +428,29 @@ def profile():
                 }
             ), 404
 
-        total_roms = len(user.roms)
-        total_saves = sum(len(rom.saves) for rom in user.roms)
-        total_storage_used = sum(rom.size for rom in user.roms)
-
-        recent_roms = sorted(user.roms, key=lambda x: x.upload_date, reverse=True)[:3]
+        # Las estadísticas se calculan en la base de datos con una sola consulta
+        # en lugar de cargar todas las ROMs y sus partidas
+        total_roms, total_storage_used, total_saves = db.session.execute(
+            select(
+                select(func.count(Rom.id))
+                .where(Rom.user_id == user.id)
+                .scalar_subquery(),
+                select(func.coalesce(func.sum(Rom.size), 0))
+                .where(Rom.user_id == user.id)
+                .scalar_subquery(),
+                select(func.count(Save.id))
+                .where(Save.user_id == user.id)
+                .scalar_subquery(),
+            )
+        ).one()
+
+        recent_roms = (
+            db.session.query(Rom.name, Rom.upload_date)
+            .filter(Rom.user_id == user.id)
+            .order_by(Rom.upload_date.desc())
+            .limit(3)
+            .all()
+        )
 
         recent_roms_data = [
             {
@@ -200,6 +460,11 @@ def profile():
             for rom in recent_roms
         ]
 
+        # Bytes que cuentan para la cuota, ROMs y partidas incluidas. Se confirma
+        # por si era la primera vez que se calculaba el contador
+        used = storage_used(user.id)
+        db.session.commit()
+
         response_data = {
             "success": True,
             "user": {
@@ -219,6 +484,8 @@ def profile():
                 "total_roms": total_roms,
                 "total_saves": total_saves,
                 "total_storage_used": total_storage_used,
+                "storage_used": used,
+                "storage_quota": app.config["STORAGE_QUOTA"] or None,
                 "recent_roms": recent_roms_data,
             },
         }
@@ -237,167 +504,814 @@ def profile():
 
 @app.route("/api/uploadroms", methods=["POST"])
 @jwt_required()
+@rate_limit("upload")
 @swag_from("docs/uploadroms.yml")
 def uploadroms():
-    username = get_jwt_identity()
-    user = User.query.filter_by(username=username).first()
+    user_id = current_user_id()
     include_saves = request.form.get("include_saves", "false") == "true"
 
-    if "roms" not in request.files:
+    # Las ROMs ya vinculadas con /api/attachroms pueden enviar solo sus partidas
+    if "roms" not in request.files and not (include_saves and "saves" in request.files):
         return jsonify({"error": "No se han seleccionado ROMs"}), 400
 
-    roms = request.files.getlist("roms")
-    saves = request.files.getlist("saves")
-    user_directory = os.path.join(app.config["ROM_FOLDER"], str(user.id))
+    roms = [
+        (rom.filename, get_file_size(rom), rom)
+        for rom in request.files.getlist("roms")
+        if allowed_file(rom.filename)
+    ]
+    # Solo se lee la cabecera, así los ficheros que no son ROMs no llegan a
+    # escribirse ni a hashearse
+    roms = [
+        rom
+        for rom in roms
+        if app.config["MIN_ROM_SIZE"] <= rom[1] <= app.config["MAX_ROM_SIZE"]
+        and read_rom_metadata(rom[2], rom[0]) is not None
+    ]
+    saves = (
+        [(save.filename, save) for save in request.files.getlist("saves")]
+        if include_saves
+        else []
+    )
 
-    rom_ids = {}
-    new_roms = []
+    # Con async=true los ficheros se preparan en disco y se procesan en segundo
+    # plano; el cliente consulta el progreso en /api/ingestjobs/<id>
+    if request.form.get("async", "false") == "true":
+        try:
+            check_storage(user_id, sum(size for _, size, _ in roms))
+            job = start_ingest_job(app, user_id, roms, saves)
+        except QuotaExceededError as e:
+            return quota_exceeded(e)
+        except Exception:
+            traceback.print_exc()
+            db.session.rollback()
+            return jsonify({"error": "Error al subir las ROMs"}), 500
+        return jsonify({"msg": "ROMs en proceso", "job_id": job.id}), 202
 
-    for rom in roms:
-        if not allowed_file(rom.filename):
-            continue
+    try:
+        rom_ids, new_roms = ingest_roms(
+            user_id,
+            [{"name": name, "size": size, "file": file} for name, size, file in roms],
+        )
+        if saves:
+            ingest_saves(user_id, rom_ids, saves)
+        new_hashes = [rom.hash for rom in new_roms]
+        db.session.commit()
+    except QuotaExceededError as e:
+        db.session.rollback()
+        return quota_exceeded(e)
+    except Exception:
+        traceback.print_exc()
+        db.session.rollback()
+        return jsonify({"error": "Error al subir las ROMs"}), 500
 
-        try:
-            rom_size = get_file_size(rom)
-            if rom_size < (32 * 1024) or rom_size > (32 * 1024 * 1024):
-                continue
+    for rom_hash in new_hashes:
+        schedule_blob_compression(rom_hash)
 
-            rom_name = rom.filename
-            file_path = os.path.join(user_directory, "roms", rom_name)
-            rom_path = os.path.join(str(user.id), "roms", rom_name)
+    return jsonify({"msg": "ROMs subidos"}), 200
 
-            rom_hash = calculate_hash_and_save_streaming(rom, file_path)
-            existing_rom = Rom.query.filter_by(hash=rom_hash, user_id=user.id).first()
-            if existing_rom:
-                rom_ids[existing_rom.name] = existing_rom.id
-                if os.path.exists(file_path):
-                    os.replace(rom_name, file_path)
-                continue
 
-            new_rom = Rom(
-                name=rom_name,
+ARCHIVE_MIMETYPES = {"application/zip", "application/x-zip-compressed"}
+
+
+@app.route("/api/importroms", methods=["POST"])
+@jwt_required()
+@rate_limit("upload")
+@swag_from("docs/importroms.yml")
+def importroms():
+    user_id = current_user_id()
+
+    # El zip llega como cuerpo de la petición y se procesa mientras se recibe,
+    # sin pasar por el formulario multipart ni por ficheros temporales
+    if request.mimetype not in ARCHIVE_MIMETYPES:
+        return jsonify({"error": "El archivo debe enviarse como application/zip"}), 415
+
+    try:
+        new_roms, skipped = import_rom_archive(user_id, request.stream)
+        new_hashes = [rom.hash for rom in new_roms]
+        db.session.commit()
+    except QuotaExceededError as e:
+        db.session.rollback()
+        return quota_exceeded(e)
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({"error": f"Archivo no válido: {e}"}), 400
+    except Exception:
+        traceback.print_exc()
+        db.session.rollback()
+        return jsonify({"error": "Error al importar el archivo"}), 500
+
+    for rom_hash in new_hashes:
+        schedule_blob_compression(rom_hash)
+
+    return jsonify(
+        {"msg": "Archivo importado", "imported": len(new_hashes), "skipped": skipped}
+    ), 200
+
+
+@app.route("/api/ingestjobs/<string:job_id>", methods=["GET"])
+@jwt_required()
+@swag_from("docs/ingestjob.yml")
+def ingestjob(job_id):
+    user_id = current_user_id()
+    job = IngestJob.query.filter_by(id=job_id, user_id=user_id).first()
+
+    if not job:
+        return jsonify({"error": "Proceso no encontrado"}), 404
+
+    return jsonify(
+        {
+            "id": job.id,
+            "status": job.status,
+            "total": job.total,
+            "processed": job.processed,
+            "created_date": job.created_date,
+            "finished_date": job.finished_date,
+        }
+    ), 200
+
+
+def parse_rom_entries(data):
+    entries = data.get("roms") if isinstance(data, dict) else None
+    if not isinstance(entries, list) or not entries:
+        return None, "No se han indicado ROMs"
+    if len(entries) > app.config["MAX_ROM_BATCH"]:
+        return None, "Demasiadas ROMs en una sola petición"
+
+    for entry in entries:
+        entry_error = validate_rom_entry(entry)
+        if entry_error:
+            return None, entry_error
+        entry["hash"] = entry["hash"].lower()
+
+    return entries, None
+
+
+@app.route("/api/checkroms", methods=["POST"])
+@jwt_required()
+@swag_from("docs/checkroms.yml")
+def checkroms():
+    user_id = current_user_id()
+    entries, error = parse_rom_entries(request.get_json(silent=True))
+
+    if error:
+        return jsonify({"error": error}), 400
+
+    hashes = {entry["hash"] for entry in entries}
+    owned_hashes = {
+        rom_hash
+        for (rom_hash,) in db.session.query(Rom.hash).filter(
+            Rom.user_id == user_id, Rom.hash.in_(hashes)
+        )
+    }
+
+    # Las que el usuario no tiene reciben siempre un reto, exista o no el blob,
+    # para que la respuesta no desvele qué ROMs han subido otros usuarios
+    results = []
+    for entry in entries:
+        result = {"name": entry["name"], "hash": entry["hash"]}
+        if entry["hash"] in owned_hashes:
+            result["status"] = "owned"
+        else:
+            result["status"] = "challenge"
+            result["challenge"] = issue_challenge(user_id, entry["hash"], entry["size"])
+        results.append(result)
+
+    return jsonify({"roms": results}), 200
+
+
+@app.route("/api/attachroms", methods=["POST"])
+@jwt_required()
+@swag_from("docs/attachroms.yml")
+def attachroms():
+    user_id = current_user_id()
+    entries, error = parse_rom_entries(request.get_json(silent=True))
+
+    if error:
+        return jsonify({"error": error}), 400
+
+    hashes = {entry["hash"] for entry in entries}
+    owned_hashes = {
+        rom_hash
+        for (rom_hash,) in db.session.query(Rom.hash).filter(
+            Rom.user_id == user_id, Rom.hash.in_(hashes)
+        )
+    }
+    blobs = {
+        blob.hash: blob
+        for blob in RomBlob.query.filter(RomBlob.hash.in_(hashes)).with_for_update()
+    }
+
+    # Solo se vincula un blob ajeno si el cliente demuestra que tiene la ROM
+    # respondiendo al reto de /api/checkroms
+    attached = []
+    missing = []
+    attached_size = 0
+    for entry in entries:
+        rom_hash = entry["hash"]
+        if rom_hash in owned_hashes:
+            attached.append(rom_hash)
+            continue
+
+        blob = blobs.get(rom_hash)
+        if not blob or not verify_proof(user_id, entry, blob):
+            missing.append(rom_hash)
+            continue
+
+        blob.ref_count += 1
+        db.session.add(
+            Rom(
+                name=entry["name"],
                 hash=rom_hash,
-                size=rom_size,
-                path=rom_path,
-                user_id=user.id,
+                size=blob.size,
+                path=blob.path,
+                user_id=user_id,
             )
-            new_roms.append(new_rom)
+        )
+        owned_hashes.add(rom_hash)
+        attached.append(rom_hash)
+        attached_size += blob.size
+
+    try:
+        reserve_storage(user_id, attached_size)
+        db.session.commit()
+    except QuotaExceededError as e:
+        db.session.rollback()
+        return quota_exceeded(e)
+    except Exception:
+        traceback.print_exc()
+        db.session.rollback()
+        return jsonify({"error": "Error al vincular las ROMs"}), 500
+
+    return jsonify({"attached": attached, "missing": missing}), 200
+
+
+def upload_status(upload):
+    return {
+        "id": upload.id,
+        "kind": upload.kind,
+        "name": upload.name,
+        "hash": upload.hash,
+        "size": upload.size,
+        "received": upload.received,
+        "chunk_size": app.config["UPLOAD_CHUNK_SIZE"],
+        "expires_date": upload.expires_date.isoformat(),
+    }
 
-        except Exception as e:
-            app.logger.error(f"Error processing ROM {rom.filename}: {str(e)}")
-            continue
 
+def expire_uploads(user_id):
+    expired = UploadSession.query.filter(
+        UploadSession.user_id == user_id,
+        UploadSession.expires_date < datetime.now(),
+    ).all()
+    for upload in expired:
+        discard_upload(upload)
+        db.session.delete(upload)
+
+
+@app.route("/api/uploads", methods=["POST"])
+@jwt_required()
+@rate_limit("upload")
+@swag_from("docs/createupload.yml")
+def createupload():
+    user_id = current_user_id()
+    data = request.get_json(silent=True)
+    kind = data.get("kind", "rom") if isinstance(data, dict) else None
+
+    if kind not in ("rom", "save"):
+        return jsonify({"error": "Tipo de subida inválido"}), 400
+
+    entry_error = (
+        validate_rom_entry(data) if kind == "rom" else validate_file_entry(data)
+    )
+    if entry_error:
+        return jsonify({"error": entry_error}), 400
+
+    file_hash = data["hash"].lower()
+    size = data["size"]
+    rom = None
+
+    if kind == "rom":
+        if size < app.config["MIN_ROM_SIZE"] or size > app.config["MAX_ROM_SIZE"]:
+            return jsonify({"error": "Tamaño de ROM no permitido"}), 400
+        # Solo se miran las ROMs del usuario: decir si otro la ha subido
+        # desvelaría su biblioteca. Si el blob ya existe, finalize lo reutiliza
+        if Rom.query.filter_by(hash=file_hash, user_id=user_id).first():
+            return jsonify({"error": "La ROM ya está en tu biblioteca"}), 409
+    else:
+        if size > app.config["MAX_SAVE_SIZE"]:
+            return jsonify({"error": "Tamaño de partida no permitido"}), 400
+        rom_hash = str(data.get("rom_hash", "")).lower()
+        rom = Rom.query.filter_by(hash=rom_hash, user_id=user_id).first()
+        if not rom:
+            return jsonify({"error": "ROM no encontrada"}), 404
+
+    # Se comprueba la cuota antes de aceptar ningún fragmento
     try:
-        if new_roms:
-            db.session.add_all(new_roms)
-            db.session.flush()
+        check_storage(user_id, size)
+    except QuotaExceededError as e:
+        return quota_exceeded(e)
 
-            for rom in new_roms:
-                rom_ids[rom.name] = rom.id
+    try:
+        expire_uploads(user_id)
+        upload = UploadSession(
+            id=uuid.uuid4().hex,
+            kind=kind,
+            name=data["name"],
+            hash=file_hash,
+            size=size,
+            received=0,
+            expires_date=datetime.now() + app.config["UPLOAD_SESSION_EXPIRES"],
+            user_id=user_id,
+            rom_id=rom.id if rom else None,
+        )
+        db.session.add(upload)
+        db.session.commit()
     except Exception:
+        traceback.print_exc()
         db.session.rollback()
-        return jsonify({"error": "Error al subir ROMs"}), 500
-
-    new_saves = []
-    if include_saves and rom_ids:
-        for save in saves:
-            try:
-                base_save_name = os.path.splitext(save.filename)[0]
-                save_extension = os.path.splitext(save.filename)[1]
-                matching_roms = [
-                    name for name in rom_ids if name.startswith(base_save_name)
-                ]
-
-                if matching_roms:
-                    rom_name = matching_roms[0]
-                    rom_id = rom_ids[rom_name]
-
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    unique_id = str(uuid.uuid4())[:8]
-                    save_size = get_file_size(save)
-                    save_name = save.filename
-                    unique_save_name = (
-                        f"{base_save_name}_{timestamp}_{unique_id}{save_extension}"
-                    )
-                    file_save_path = os.path.join(
-                        user_directory, "saves", unique_save_name
-                    )
-                    save_path = os.path.join(str(user.id), "saves", unique_save_name)
+        return jsonify({"error": "Error al iniciar la subida"}), 500
+
+    return jsonify(upload_status(upload)), 201
+
+
+@app.route("/api/uploads/<string:upload_id>", methods=["GET"])
+@jwt_required()
+@swag_from("docs/uploadstatus.yml")
+def uploadstatus(upload_id):
+    user_id = current_user_id()
+    upload = UploadSession.query.filter_by(id=upload_id, user_id=user_id).first()
+
+    if not upload:
+        return jsonify({"error": "Subida no encontrada"}), 404
+
+    return jsonify(upload_status(upload)), 200
+
+
+@app.route("/api/uploads/<string:upload_id>", methods=["PUT"])
+@jwt_required()
+@swag_from("docs/uploadchunk.yml")
+def uploadchunk(upload_id):
+    user_id = current_user_id()
+    upload = UploadSession.query.filter_by(id=upload_id, user_id=user_id).first()
+
+    if not upload:
+        return jsonify({"error": "Subida no encontrada"}), 404
+    if upload.expires_date < datetime.now():
+        return jsonify({"error": "La subida ha caducado"}), 410
+
+    length = request.content_length
+    if not length:
+        return jsonify({"error": "Falta la cabecera Content-Length"}), 411
+    if length > app.config["UPLOAD_CHUNK_SIZE"]:
+        return jsonify({"error": "El fragmento es demasiado grande"}), 413
+
+    start = upload.received
+    content_range = parse_content_range_header(request.headers.get("Content-Range"))
+    if content_range is not None:
+        if (
+            content_range.start is None
+            or content_range.stop - content_range.start != length
+            or content_range.length not in (None, upload.size)
+        ):
+            return jsonify({"error": "Cabecera Content-Range inválida"}), 400
+        start = content_range.start
+
+    # Solo se aceptan fragmentos contiguos a lo ya recibido para que el
+    # fichero parcial nunca tenga huecos
+    if start > upload.received or start + length > upload.size:
+        return jsonify(
+            {"error": "Rango fuera de la subida", **upload_status(upload)}
+        ), 416
+
+    # El fragmento se recibe sin transacción abierta: un cliente lento no debe
+    # retener una conexión del pool ni el bloqueo de la subida
+    db.session.commit()
+    chunk_path, written = receive_upload_chunk(upload, request.stream, length)
+
+    try:
+        if written != length:
+            return jsonify(
+                {"error": "Fragmento incompleto", **upload_status(upload)}
+            ), 400
+
+        upload = (
+            UploadSession.query.filter_by(id=upload_id, user_id=user_id)
+            .with_for_update()
+            .first()
+        )
+        if not upload:
+            return jsonify({"error": "Subida no encontrada"}), 404
+        # Otra petición ha podido avanzar o recortar la subida mientras tanto
+        if start > upload.received:
+            status = upload_status(upload)
+            db.session.rollback()
+            return jsonify({"error": "Rango fuera de la subida", **status}), 416
+
+        with open(chunk_path, "rb") as chunk_file:
+            write_upload_chunk(upload, chunk_file, start, written)
+        upload.received = max(upload.received, start + written)
+        db.session.commit()
+    except Exception:
+        traceback.print_exc()
+        db.session.rollback()
+        return jsonify({"error": "Error al guardar el fragmento"}), 500
+    finally:
+        os.remove(chunk_path)
+
+    return jsonify(upload_status(upload)), 200
+
+
+@app.route("/api/uploads/<string:upload_id>/finalize", methods=["POST"])
+@jwt_required()
+@swag_from("docs/finalizeupload.yml")
+def finalizeupload(upload_id):
+    user_id = current_user_id()
+    upload = (
+        UploadSession.query.filter_by(id=upload_id, user_id=user_id)
+        .with_for_update()
+        .first()
+    )
+
+    if not upload:
+        return jsonify({"error": "Subida no encontrada"}), 404
 
-                    save_file_streaming(save, file_save_path)
+    part_path = upload_part_path(upload)
+    if upload.received != upload.size or not os.path.isfile(part_path):
+        return jsonify(
+            {"error": "La subida está incompleta", **upload_status(upload)}
+        ), 409
 
-                    new_save = Save(
-                        name=save_name,
-                        size=save_size,
-                        path=save_path,
-                        user_id=user.id,
-                        rom_id=rom_id,
+    try:
+        # Hashear 32 MB es trabajo de CPU: con gevent se hace fuera del bucle
+        if run_blocking(finish_upload_hash, upload) != upload.hash:
+            discard_upload(upload)
+            db.session.delete(upload)
+            db.session.commit()
+            return jsonify({"error": "El hash del fichero no coincide"}), 422
+
+        if upload.kind == "rom":
+            owned = Rom.query.filter_by(hash=upload.hash, user_id=user_id).first()
+            if not owned:
+                reserve_storage(user_id, upload.size)
+
+            blob = RomBlob.query.filter_by(hash=upload.hash).with_for_update().first()
+            if not blob:
+                with open(part_path, "rb") as f:
+                    metadata = read_rom_metadata(f, upload.name)
+                    if metadata:
+                        scanner = run_blocking(scan_rom, f)
+                        if metadata["save_type"] is None:
+                            metadata["save_type"] = scanner.save_type or "none"
+                        metadata["crc32"] = scanner.crc32
+
+                if metadata is None:
+                    # Se deshace la reserva de cuota antes de borrar la subida
+                    db.session.rollback()
+                    discard_upload(upload)
+                    db.session.delete(upload)
+                    db.session.commit()
+                    return jsonify({"error": "El fichero no es una ROM válida"}), 422
+
+                # Se copia sin soltar la parte: si el commit falla la subida
+                # sigue completa y se puede volver a finalizar
+                blob_storage.copy(blob_relative_path(upload.hash), part_path)
+                blob = insert_rom_blobs(
+                    [
+                        dict(
+                            hash=upload.hash,
+                            size=upload.size,
+                            path=blob_relative_path(upload.hash),
+                            ref_count=0,
+                            **metadata,
+                        )
+                    ]
+                )[upload.hash]
+
+            if not owned:
+                blob.ref_count += 1
+                db.session.add(
+                    Rom(
+                        name=upload.name,
+                        hash=upload.hash,
+                        size=upload.size,
+                        path=blob.path,
+                        user_id=user_id,
                     )
-                    new_saves.append(new_save)
+                )
+        else:
+            with open(part_path, "rb") as f:
+                save_data = f.read()
+            db.session.add(
+                store_save_version(user_id, upload.rom_id, upload.name, save_data)
+            )
 
-            except Exception as e:
-                app.logger.error(f"Error processing save{save.filename}: {str(e)}")
+        db.session.delete(upload)
+        db.session.commit()
+    except QuotaExceededError as e:
+        # La subida se conserva para completarla tras liberar espacio
+        db.session.rollback()
+        return quota_exceeded(e)
+    except Exception:
+        traceback.print_exc()
+        db.session.rollback()
+        return jsonify({"error": "Error al completar la subida"}), 500
 
-        if new_saves:
-            db.session.add_all(new_saves)
+    # La parte solo se borra cuando el blob o la partida ya están registrados
+    discard_upload(upload)
+    if upload.kind == "rom":
+        schedule_blob_compression(upload.hash)
+
+    return jsonify({"msg": "Subida completada", "hash": upload.hash}), 200
+
+
+@app.route("/api/uploads/<string:upload_id>", methods=["DELETE"])
+@jwt_required()
+@swag_from("docs/cancelupload.yml")
+def cancelupload(upload_id):
+    user_id = current_user_id()
+    upload = UploadSession.query.filter_by(id=upload_id, user_id=user_id).first()
+
+    if not upload:
+        return jsonify({"error": "Subida no encontrada"}), 404
 
     try:
+        discard_upload(upload)
+        db.session.delete(upload)
         db.session.commit()
+    except Exception:
+        db.session.rollback()
+        return jsonify({"error": "No se ha podido cancelar la subida"}), 500
+
+    return jsonify({"msg": "Subida cancelada"}), 200
+
+
+@app.route("/api/syncsaves", methods=["POST"])
+@jwt_required()
+@swag_from("docs/syncsaves.yml")
+def syncsaves():
+    user_id = current_user_id()
+
+    try:
+        entries = json.loads(request.form.get("manifest", ""))
+    except ValueError:
+        return jsonify({"error": "Manifiesto inválido"}), 400
+
+    if not isinstance(entries, list) or not entries:
+        return jsonify({"error": "No se han indicado partidas"}), 400
+    if len(entries) > app.config["MAX_ROM_BATCH"]:
+        return jsonify({"error": "Demasiadas partidas en una sola petición"}), 400
+
+    for entry in entries:
+        entry_error = validate_file_entry(entry)
+        if entry_error:
+            return jsonify({"error": entry_error}), 400
+        if entry.get("kind", "save") not in ("save", "state"):
+            return jsonify({"error": "Tipo de partida inválido"}), 400
+
+    rom_hashes = {str(entry.get("rom_hash", "")).lower() for entry in entries}
+    rom_ids = dict(
+        db.session.query(Rom.hash, Rom.id).filter(
+            Rom.user_id == user_id, Rom.hash.in_(rom_hashes)
+        )
+    )
+    latest_ids = (
+        db.session.query(func.max(Save.id))
+        .filter(Save.user_id == user_id, Save.rom_id.in_(rom_ids.values()))
+        .group_by(Save.rom_id, Save.kind)
+    )
+    latest_hashes = {
+        (save.rom_id, save.kind): save.hash
+        for save in Save.query.filter(Save.id.in_(latest_ids))
+    }
+
+    results = []
+    stored_paths = []
+    try:
+        for entry in entries:
+            rom_hash = str(entry.get("rom_hash", "")).lower()
+            save_hash = entry["hash"].lower()
+            kind = entry.get("kind", "save")
+            result = {
+                "rom_hash": rom_hash,
+                "name": entry["name"],
+                "kind": kind,
+                "hash": save_hash,
+            }
+            results.append(result)
+
+            rom_id = rom_ids.get(rom_hash)
+            if rom_id is None:
+                result["status"] = "rejected"
+                continue
+
+            # Sin cambios respecto a la última versión: no hace falta enviar nada
+            if latest_hashes.get((rom_id, kind)) == save_hash:
+                result["status"] = "unchanged"
+                continue
+
+            save_file = request.files.get(save_hash)
+            if save_file is None:
+                result["status"] = "missing"
+                continue
+
+            data = save_file.read(app.config["MAX_SAVE_SIZE"] + 1)
+            if (
+                len(data) > app.config["MAX_SAVE_SIZE"]
+                or calculate_file_hash(io.BytesIO(data)) != save_hash
+            ):
+                result["status"] = "rejected"
+                continue
+
+            new_save = store_save_version(user_id, rom_id, entry["name"], data, kind)
+            stored_paths.append(new_save.path)
+            db.session.add(new_save)
+            db.session.flush()
+            latest_hashes[(rom_id, kind)] = save_hash
+            result["status"] = "stored"
+            result["id"] = new_save.id
+
+        db.session.commit()
+    except QuotaExceededError as e:
+        db.session.rollback()
+        for path in stored_paths:
+            user_storage.delete(path)
+        return quota_exceeded(e)
     except Exception:
         traceback.print_exc()
         db.session.rollback()
-        return jsonify({"error": "Error al subir las ROMs"}), 500
+        for path in stored_paths:
+            user_storage.delete(path)
+        return jsonify({"error": "Error al sincronizar las partidas"}), 500
 
-    return jsonify({"msg": "ROMs subidos"}), 200
+    return jsonify({"saves": results}), 200
+
+
+# Orden disponible en /api/loadroms: columna y si es descendente
+ROM_SORTS = {
+    "date": (Rom.upload_date, True),
+    "name": (Rom.name, False),
+    "size": (Rom.size, True),
+}
+# Tipo del valor de la columna de orden dentro del cursor
+CURSOR_TYPES = {"date": str, "name": str, "size": int}
 
 
 @app.route("/api/loadroms", methods=["GET"])
 @jwt_required()
+@use_replica
 @swag_from("docs/loadroms.yml")
 def loadroms():
-    username = get_jwt_identity()
-    user = User.query.filter_by(username=username).first()
-    roms = Rom.query.filter_by(user_id=user.id).all()
-    return jsonify(
+    user_id = current_user_id()
+    sort = request.args.get("sort", "date")
+    search = request.args.get("q", "").strip()
+    cursor = request.args.get("cursor")
+
+    if sort not in ROM_SORTS:
+        return jsonify({"error": "Orden no válido"}), 400
+
+    try:
+        limit = int(request.args.get("limit", app.config["ROM_PAGE_SIZE"]))
+    except ValueError:
+        return jsonify({"error": "Límite no válido"}), 400
+    limit = max(1, min(limit, app.config["MAX_ROM_PAGE_SIZE"]))
+
+    # La versión de la biblioteca cambia con cada alta o baja de ROM, así el
+    # cliente puede revalidar con If-None-Match sin descargar la lista
+    rom_count, last_rom_id = (
+        db.session.query(func.count(Rom.id), func.max(Rom.id))
+        .filter(Rom.user_id == user_id)
+        .one()
+    )
+    etag = hashlib.sha256(
+        f"{rom_count}:{last_rom_id}:{request.query_string.decode()}".encode()
+    ).hexdigest()[:32]
+
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
+
+    sort_column, descending = ROM_SORTS[sort]
+    query = (
+        Rom.query.outerjoin(Rom.blob)
+        .options(contains_eager(Rom.blob))
+        .filter(Rom.user_id == user_id)
+    )
+
+    # Además del nombre se busca por el título y el código de juego de la cabecera
+    if search:
+        escaped = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        query = query.filter(
+            or_(
+                Rom.name.ilike(f"%{escaped}%", escape="\\"),
+                RomBlob.title.ilike(f"%{escaped}%", escape="\\"),
+                RomBlob.game_code == search.upper(),
+            )
+        )
+
+    if cursor:
+        try:
+            last_value, last_id = decode_cursor(cursor)
+            # El cursor lo envía el cliente: un valor de otro tipo que la
+            # columna haría fallar la consulta en Postgres
+            if (
+                not isinstance(last_value, CURSOR_TYPES[sort])
+                or not isinstance(last_id, int)
+                or isinstance(last_value, bool)
+                or isinstance(last_id, bool)
+            ):
+                raise TypeError("Cursor de otro orden")
+            if sort == "date":
+                last_value = datetime.fromisoformat(last_value)
+        except (ValueError, TypeError):
+            return jsonify({"error": "Cursor no válido"}), 400
+
+        position = tuple_(sort_column, Rom.id)
+        query = query.filter(
+            position < (last_value, last_id)
+            if descending
+            else position > (last_value, last_id)
+        )
+
+    if descending:
+        query = query.order_by(sort_column.desc(), Rom.id.desc())
+    else:
+        query = query.order_by(sort_column.asc(), Rom.id.asc())
+
+    roms = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(roms) > limit:
+        roms = roms[:limit]
+        last_value = getattr(roms[-1], sort_column.key)
+        if sort == "date":
+            last_value = last_value.isoformat()
+        next_cursor = encode_cursor([last_value, roms[-1].id])
+
+    response = jsonify(
         [
             {
                 "name": rom.name,
                 "hash": rom.hash,
                 "size": rom.size,
                 "upload_date": rom.upload_date,
+                "platform": rom.blob.platform if rom.blob else None,
+                "title": rom.blob.title if rom.blob else None,
+                "game_code": rom.blob.game_code if rom.blob else None,
+                "save_type": rom.blob.save_type if rom.blob else None,
             }
             for rom in roms
         ]
     )
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
 
 
 @app.route("/api/loadrom/<string:rom_hash>", methods=["GET"])
 @jwt_required()
+@rate_limit("download")
 @swag_from("docs/loadrom.yml")
 def loadrom(rom_hash):
-    username = get_jwt_identity()
-    user = User.query.filter_by(username=username).first()
-    rom = Rom.query.filter_by(hash=rom_hash, user_id=user.id).first()
+    user_id = current_user_id()
+    rom = (
+        Rom.query.options(joinedload(Rom.blob))
+        .filter_by(hash=rom_hash, user_id=user_id)
+        .first()
+    )
 
     if not rom:
         return jsonify({"error": "ROM no encontrada"}), 404
 
     try:
-        if not rom.path.startswith(str(user.id)):
-            return jsonify({"error": "Acceso denegado"}), 403
-
-        relative = PurePath(rom.path)
-        safe_path = Path(app.config["ROM_FOLDER"]) / relative
-
-        if not os.path.isfile(safe_path):
+        storage, blob_key = blob_storage, blob_relative_path(rom.hash)
+        if rom.blob is None:
+            # ROM anterior al almacén de blobs que aún no se ha migrado con
+            # flask backfill-blobs, sigue en la carpeta del usuario
+            storage, blob_key = user_storage, rom.path
+            if not rom.path.startswith(f"{user_id}{os.sep}"):
+                return jsonify({"error": "Acceso denegado"}), 403
+
+        if not storage.exists(blob_key):
             return jsonify({"error": "Archivo de ROM no encontrado"}), 404
 
-        return stream_file_response(
-            file_path=str(safe_path),
+        response = storage_file_response(
+            storage,
+            blob_key,
             filename=rom.name,
             chunk_size=32768,
             cache_timeout=3600,
+            etag=rom.hash,
+            immutable=True,
+            precompressed=True,
+            cached=True,
         )
+        # El emulador configura la memoria de guardado sin tener que detectarla
+        if rom.blob and rom.blob.save_type:
+            response.headers["X-Save-Type"] = rom.blob.save_type
+        return response
     except Exception:
         traceback.print_exc()
         return jsonify({"error": "Error al cargar la ROM"}), 500
@@ -407,27 +1321,52 @@ def loadrom(rom_hash):
 @jwt_required()
 @swag_from("docs/deleterom.yml")
 def deleterom(rom_hash):
-    username = get_jwt_identity()
-    user = User.query.filter_by(username=username).first()
-    rom = Rom.query.filter_by(hash=rom_hash, user_id=user.id).first()
+    user_id = current_user_id()
+    rom = Rom.query.filter_by(hash=rom_hash, user_id=user_id).first()
 
     if not rom:
         return jsonify({"error": "ROM no encontrada"}), 404
 
-    if not rom.path.startswith(str(user.id)):
-        return jsonify({"error": "Acceso denegado"}), 403
-
     try:
-        relative = PurePath(rom.path)
-        safe_path = Path(app.config["ROM_FOLDER"]) / relative
+        # ref_count se lee con la fila bloqueada, no de la sesión
+        blob = (
+            RomBlob.query.filter_by(hash=rom.hash)
+            .with_for_update()
+            .populate_existing()
+            .first()
+        )
+        # Las partidas de la ROM se borran con ella y dejan de contar en la cuota
+        saves = (
+            db.session.query(Save.path, func.coalesce(Save.stored_size, Save.size))
+            .filter(Save.rom_id == rom.id)
+            .all()
+        )
+        db.session.execute(delete(Save).where(Save.rom_id == rom.id))
+        # Las subidas de partidas a medias apuntan a la ROM y se descartan
+        pending_uploads = UploadSession.query.filter_by(rom_id=rom.id).all()
+        for upload in pending_uploads:
+            db.session.delete(upload)
+        db.session.delete(rom)
+        release_storage(user_id, rom.size + sum(size for _, size in saves))
 
-        if not os.path.isfile(safe_path):
-            return jsonify({"error": "Error al eliminar la ROM"}), 500
+        if blob:
+            blob.ref_count -= 1
+            if blob.ref_count <= 0:
+                db.session.delete(blob)
+                db.session.flush()
+                # El fichero se borra sin soltar el bloqueo: quien suba la misma
+                # ROM espera al commit, ya no ve la fila y vuelve a escribirlo
+                remove_blob(rom_hash)
 
-        os.remove(safe_path)
-        db.session.delete(rom)
         db.session.commit()
 
+        for save_path, _ in saves:
+            user_storage.delete(save_path)
+        for upload in pending_uploads:
+            discard_upload(upload)
+        if not blob and rom.path.startswith(f"{user_id}{os.sep}"):
+            user_storage.delete(rom.path)
+
     except Exception:
         db.session.rollback()
         return jsonify({"error": "No se ha podido eliminar la ROM"}), 500
@@ -437,17 +1376,18 @@ def deleterom(rom_hash):
 
 @app.route("/api/loadsaves/<string:rom_hash>", methods=["GET"])
 @jwt_required()
+@use_replica
 @swag_from("docs/loadsaves.yml")
 def loadsaves(rom_hash):
-    username = get_jwt_identity()
-    user = User.query.filter_by(username=username).first()
-    rom = Rom.query.filter_by(hash=rom_hash, user_id=user.id).first()
+    user_id = current_user_id()
+    rom = Rom.query.filter_by(hash=rom_hash, user_id=user_id).first()
 
     if not rom:
         return jsonify({"error": "ROM no encontrada"}), 404
 
+    kind = request.args.get("kind", "save")
     saves = (
-        Save.query.filter_by(rom_id=rom.id)
+        Save.query.filter_by(rom_id=rom.id, kind=kind)
         .order_by(Save.upload_date.desc())
         .limit(3)
         .all()
@@ -457,6 +1397,7 @@ def loadsaves(rom_hash):
             {
                 "id": save.id,
                 "name": save.name,
+                "kind": save.kind,
                 "size": save.size,
                 "upload_date": save.upload_date,
             }
@@ -467,27 +1408,33 @@ def loadsaves(rom_hash):
 
 @app.route("/api/loadsave/<int:save_id>", methods=["GET"])
 @jwt_required()
+@rate_limit("download")
 @swag_from("docs/loadsave.yml")
 def loadsave(save_id):
-    username = get_jwt_identity()
-    user = User.query.filter_by(username=username).first()
-    save = Save.query.filter_by(id=save_id, user_id=user.id).first()
+    user_id = current_user_id()
+    save = Save.query.filter_by(id=save_id, user_id=user_id).first()
 
     if not save:
         return jsonify({"error": "Save no encontrada"}), 404
 
     try:
-        if not save.path.startswith(str(user.id)):
+        if not save.path.startswith(str(user_id)):
             return jsonify({"error": "Acceso denegado"}), 403
 
-        relative = PurePath(save.path)
-        safe_path = Path(app.config["ROM_FOLDER"]) / relative
-
-        if not os.path.isfile(safe_path):
+        if not user_storage.exists(save.path):
             return jsonify({"error": "Archivo de partida no encontrado"}), 404
 
-        return stream_file_response(
-            file_path=str(safe_path),
+        if save.base_id is not None:
+            return bytes_response(
+                load_save_data(save),
+                filename=save.name,
+                cache_timeout=1800,
+                etag=save.hash,
+            )
+
+        return storage_file_response(
+            user_storage,
+            save.path,
             filename=save.name,
             chunk_size=8192,
             cache_timeout=1800,
@@ -497,5 +1444,72 @@ def loadsave(save_id):
         return jsonify({"error": "Hubo un error inesperado"}), 500
 
 
+@app.route("/api/export", methods=["GET"])
+@jwt_required()
+@rate_limit("download")
+@swag_from("docs/export.yml")
+def exportlibrary():
+    user_id = current_user_id()
+
+    try:
+        entries = build_library_export(user_id)
+    except Exception:
+        traceback.print_exc()
+        db.session.rollback()
+        return jsonify({"error": "Error al preparar la exportación"}), 500
+
+    # El zip se genera al vuelo pero su contenido es fijo mientras la
+    # biblioteca no cambie, así una descarga cortada se retoma con Range
+    segments, total_size = build_stored_zip(entries)
+    etag = export_etag(entries)
+    headers = {
+        "ETag": quote_etag(etag),
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, no-cache",
+        "Content-Disposition": "attachment; filename=gba-library.zip",
+    }
+
+    if request.if_none_match.contains_weak(etag):
+        return app.response_class(status=304, headers=headers)
+
+    start, end = 0, total_size
+    status = 200
+    range_header = request.headers.get("Range")
+    if range_header and if_range_matches(etag, None):
+        ranges = parse_byte_ranges(range_header, total_size)
+        if ranges == []:
+            headers["Content-Range"] = f"bytes */{total_size}"
+            return app.response_class(status=416, headers=headers)
+        # Con varios rangos se envía el archivo completo
+        if ranges and len(ranges) == 1:
+            start, end = ranges[0]
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{total_size}"
+
+    headers["Content-Length"] = str(end - start)
+    return app.response_class(
+        stream_with_context(iter_zip_range(segments, start, end)),
+        status=status,
+        mimetype="application/zip",
+        headers=headers,
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+@swag_from("docs/metrics.yml")
+def metrics():
+    # Sin token configurado la ruta no existe: las métricas nunca son públicas
+    token = app.config["METRICS_TOKEN"]
+    if not token:
+        return jsonify({"error": "No encontrado"}), 404
+    if not hmac.compare_digest(
+        request.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()
+    ):
+        return jsonify({"error": "No autorizado"}), 401
+
+    data, content_type = render_metrics()
+    return app.response_class(data, content_type=content_type)
+
+
 # if __name__ == "__main__":
 #     app.run(debug=True)
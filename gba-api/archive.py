@@ -0,0 +1,344 @@
+import zlib
+import struct
+
+# Cabecera local de cada entrada del zip. Se lee el fichero en orden, sin el
+# directorio central del final, para poder procesarlo mientras se recibe
+LOCAL_SIGNATURE = 0x04034B50
+LOCAL_HEADER = struct.Struct("<HHHHHIIIHH")
+DESCRIPTOR_SIGNATURE = 0x08074B50
+ZIP64_EXTRA_ID = 0x0001
+
+FLAG_ENCRYPTED = 0x0001
+FLAG_DATA_DESCRIPTOR = 0x0008
+FLAG_UTF8 = 0x0800
+
+METHOD_STORED = 0
+METHOD_DEFLATED = 8
+
+
+class _StreamReader:
+    def __init__(self, stream, chunk_size):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._buffer = b""
+
+    def read_some(self):
+        if self._buffer:
+            data, self._buffer = self._buffer, b""
+            return data
+        return self._stream.read(self._chunk_size)
+
+    def read_exact(self, size):
+        parts = [self._buffer[:size]]
+        self._buffer = self._buffer[size:]
+        missing = size - len(parts[0])
+        while missing > 0:
+            data = self._stream.read(max(missing, self._chunk_size))
+            if not data:
+                raise ValueError("El archivo está truncado")
+            parts.append(data[:missing])
+            self._buffer = data[missing:]
+            missing -= len(parts[-1])
+        return b"".join(parts)
+
+    def unread(self, data):
+        self._buffer = data + self._buffer
+
+
+class ZipEntry:
+    def __init__(self, reader, name, flags, method, crc, compressed_size, zip64):
+        self.name = name
+        self.is_dir = name.endswith("/")
+        self._reader = reader
+        self._flags = flags
+        self._method = method
+        self._crc = crc
+        self._compressed_size = compressed_size
+        self._zip64 = zip64
+        self._chunks = None
+
+    def chunks(self, chunk_size=65536):
+        """
+        Devuelve los datos descomprimidos por trozos de como mucho chunk_size
+        bytes y comprueba el CRC al terminar. Si se deja a medias, drain()
+        continúa desde el mismo punto.
+        """
+        if self._chunks is None:
+            self._chunks = self._read_chunks(chunk_size)
+        return self._chunks
+
+    def _read_chunks(self, chunk_size):
+        crc = 0
+        if self._method == METHOD_DEFLATED:
+            data = self._inflate(chunk_size)
+        else:
+            data = self._stored(chunk_size)
+        for chunk in data:
+            crc = zlib.crc32(chunk, crc)
+            yield chunk
+
+        if self._flags & FLAG_DATA_DESCRIPTOR:
+            self._crc = self._read_descriptor()
+        if crc != self._crc:
+            raise ValueError(f"CRC incorrecto en {self.name}")
+
+    def drain(self):
+        for _ in self.chunks():
+            pass
+
+    def _inflate(self, chunk_size):
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        while not decompressor.eof:
+            data = decompressor.unconsumed_tail or self._reader.read_some()
+            if not data:
+                raise ValueError("El archivo está truncado")
+            # max_length limita la memoria aunque la entrada comprima muchísimo
+            try:
+                chunk = decompressor.decompress(data, chunk_size)
+            except zlib.error as e:
+                raise ValueError(f"Datos comprimidos no válidos en {self.name}") from e
+            if chunk:
+                yield chunk
+        self._reader.unread(decompressor.unused_data)
+
+    def _stored(self, chunk_size):
+        remaining = self._compressed_size
+        while remaining > 0:
+            chunk = self._reader.read_exact(min(remaining, chunk_size))
+            remaining -= len(chunk)
+            yield chunk
+
+    def _read_descriptor(self):
+        (value,) = struct.unpack("<I", self._reader.read_exact(4))
+        if value == DESCRIPTOR_SIGNATURE:
+            (value,) = struct.unpack("<I", self._reader.read_exact(4))
+        self._reader.read_exact(16 if self._zip64 else 8)
+        return value
+
+
+def _zip64_extra(extra):
+    position = 0
+    while position + 4 <= len(extra):
+        header_id, size = struct.unpack_from("<HH", extra, position)
+        if header_id == ZIP64_EXTRA_ID:
+            return extra[position + 4 : position + 4 + size]
+        position += 4 + size
+    return None
+
+
+def iter_zip_entries(stream, chunk_size=65536):
+    """
+    Recorre un zip a medida que se lee del stream. Cada entrada debe
+    consumirse antes de pedir la siguiente; si no, se descarta sin guardarla.
+    """
+    reader = _StreamReader(stream, chunk_size)
+    while True:
+        try:
+            signature = reader.read_exact(4)
+        except ValueError:
+            return
+        if struct.unpack("<I", signature)[0] != LOCAL_SIGNATURE:
+            # Empieza el directorio central: no hay más entradas
+            return
+
+        (
+            _,
+            flags,
+            method,
+            _,
+            _,
+            crc,
+            compressed_size,
+            uncompressed_size,
+            name_length,
+            extra_length,
+        ) = LOCAL_HEADER.unpack(reader.read_exact(LOCAL_HEADER.size))
+        raw_name = reader.read_exact(name_length)
+        extra = reader.read_exact(extra_length)
+        name = raw_name.decode("utf-8" if flags & FLAG_UTF8 else "cp437")
+
+        if flags & FLAG_ENCRYPTED:
+            raise ValueError(f"La entrada {name} está cifrada")
+        if method not in (METHOD_STORED, METHOD_DEFLATED) or (
+            method == METHOD_STORED and flags & FLAG_DATA_DESCRIPTOR
+        ):
+            raise ValueError(f"Método de compresión no soportado en {name}")
+
+        # En zip64 los tamaños que no caben en 32 bits van en el campo extra,
+        # primero el descomprimido y después el comprimido
+        zip64 = _zip64_extra(extra)
+        if zip64 is not None and compressed_size == 0xFFFFFFFF:
+            offset = 8 if uncompressed_size == 0xFFFFFFFF else 0
+            (compressed_size,) = struct.unpack_from("<Q", zip64, offset)
+
+        entry = ZipEntry(
+            reader,
+            name,
+            flags,
+            method,
+            crc,
+            compressed_size,
+            zip64 is not None,
+        )
+        yield entry
+        entry.drain()
+
+
+# Escritura de zips sin compresión. Como el tamaño de cada entrada y su CRC se
+# conocen de antemano, la posición de cada byte del archivo es fija y se puede
+# servir cualquier rango sin generar lo anterior
+CENTRAL_SIGNATURE = 0x02014B50
+END_SIGNATURE = 0x06054B50
+ZIP64_END_SIGNATURE = 0x06064B50
+ZIP64_LOCATOR_SIGNATURE = 0x07064B50
+LOCAL_RECORD = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_RECORD = struct.Struct("<IHHHHHHIIIHHHHHII")
+END_RECORD = struct.Struct("<IHHHHIIH")
+ZIP64_END_RECORD = struct.Struct("<IQHHIIQQQQ")
+ZIP64_LOCATOR = struct.Struct("<IIQI")
+ZIP64_OFFSET_EXTRA = struct.Struct("<HHQ")
+
+VERSION_DEFAULT = 20
+VERSION_ZIP64 = 45
+ZIP32_LIMIT = 0xFFFFFFFF
+
+
+class StoredEntry:
+    """
+    Entrada de un zip sin compresión. read(start, end) devuelve los trozos del
+    contenido entre esas posiciones.
+    """
+
+    def __init__(self, name, size, crc, date_time, read):
+        self.name = name
+        self.size = size
+        self.crc = crc
+        self.date_time = date_time
+        self.read = read
+
+
+def _dos_date_time(date_time):
+    if date_time is None:
+        return 0, 1 << 5 | 1
+    year = min(max(date_time.year, 1980), 2107)
+    return (
+        date_time.hour << 11 | date_time.minute << 5 | date_time.second // 2,
+        (year - 1980) << 9 | date_time.month << 5 | date_time.day,
+    )
+
+
+def _bytes_reader(data):
+    def read(start, end):
+        yield data[start:end]
+
+    return read
+
+
+def build_stored_zip(entries):
+    """
+    Calcula la disposición del zip y devuelve sus segmentos como
+    (longitud, lector) y el tamaño total.
+    """
+    segments = []
+    central = []
+    offset = 0
+
+    for entry in entries:
+        name = entry.name.encode()
+        dos_time, dos_date = _dos_date_time(entry.date_time)
+        local = LOCAL_RECORD.pack(
+            LOCAL_SIGNATURE,
+            VERSION_DEFAULT,
+            FLAG_UTF8,
+            METHOD_STORED,
+            dos_time,
+            dos_date,
+            entry.crc,
+            entry.size,
+            entry.size,
+            len(name),
+            0,
+        )
+        segments.append((len(local) + len(name), _bytes_reader(local + name)))
+        segments.append((entry.size, entry.read))
+
+        # Solo el desplazamiento puede pasar de 4 GB: cada fichero es pequeño
+        extra = b""
+        version = VERSION_DEFAULT
+        header_offset = offset
+        if offset >= ZIP32_LIMIT:
+            extra = ZIP64_OFFSET_EXTRA.pack(ZIP64_EXTRA_ID, 8, offset)
+            version = VERSION_ZIP64
+            header_offset = ZIP32_LIMIT
+        central.append(
+            CENTRAL_RECORD.pack(
+                CENTRAL_SIGNATURE,
+                version,
+                version,
+                FLAG_UTF8,
+                METHOD_STORED,
+                dos_time,
+                dos_date,
+                entry.crc,
+                entry.size,
+                entry.size,
+                len(name),
+                len(extra),
+                0,
+                0,
+                0,
+                0,
+                header_offset,
+            )
+            + name
+            + extra
+        )
+        offset += len(local) + len(name) + entry.size
+
+    directory = b"".join(central)
+    directory_offset = offset
+    end = b""
+    if directory_offset + len(directory) >= ZIP32_LIMIT or len(central) >= 0xFFFF:
+        zip64_end_offset = directory_offset + len(directory)
+        end += ZIP64_END_RECORD.pack(
+            ZIP64_END_SIGNATURE,
+            ZIP64_END_RECORD.size - 12,
+            VERSION_ZIP64,
+            VERSION_ZIP64,
+            0,
+            0,
+            len(central),
+            len(central),
+            len(directory),
+            directory_offset,
+        )
+        end += ZIP64_LOCATOR.pack(ZIP64_LOCATOR_SIGNATURE, 0, zip64_end_offset, 1)
+    end += END_RECORD.pack(
+        END_SIGNATURE,
+        0,
+        0,
+        min(len(central), 0xFFFF),
+        min(len(central), 0xFFFF),
+        min(len(directory), ZIP32_LIMIT),
+        min(directory_offset, ZIP32_LIMIT),
+        0,
+    )
+    segments.append((len(directory) + len(end), _bytes_reader(directory + end)))
+
+    return segments, sum(length for length, _ in segments)
+
+
+def iter_zip_range(segments, start, end):
+    """
+    Genera los bytes del zip entre start y end (exclusivo).
+    """
+    position = 0
+    for length, read in segments:
+        segment_end = position + length
+        if segment_end > start and position < end:
+            yield from read(
+                max(start, position) - position, min(end, segment_end) - position
+            )
+        position = segment_end
+        if position >= end:
+            break
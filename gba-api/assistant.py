@@ -0,0 +1,280 @@
+import json
+import time
+import hashlib
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime
+from threading import BoundedSemaphore, Lock
+
+import httpx
+from google import genai
+from google.genai import types
+
+from config import Config
+from models import db, Conversation, ConversationMessage
+
+SYSTEM_INSTRUCTION = (
+    "Eres un señor mayor que le gustan los videojuegos y entiendes mucho sobre ellos"
+)
+
+
+class GeminiClient:
+    """
+    Cliente del modelo. Se crea una sola vez por proceso para reutilizar las
+    conexiones HTTP entre peticiones.
+    """
+
+    def __init__(self, api_key, model, base_url=None, max_connections=None):
+        # Una conexión por hueco del semáforo: las peticiones de más esperan en
+        # el semáforo y no en la cola del pool de httpx, que se recorre entera
+        # cada vez que queda una conexión libre
+        client_args = None
+        if max_connections:
+            client_args = {
+                "limits": httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections,
+                )
+            }
+        http_options = types.HttpOptions(base_url=base_url, client_args=client_args)
+        self._client = genai.Client(api_key=api_key, http_options=http_options)
+        self.model = model
+        self._config = types.GenerateContentConfig(
+            system_instruction=SYSTEM_INSTRUCTION
+        )
+
+    def generate(self, contents):
+        response = self._client.models.generate_content(
+            model=self.model, config=self._config, contents=contents
+        )
+        return response.text
+
+    def stream(self, contents):
+        for chunk in self._client.models.generate_content_stream(
+            model=self.model, config=self._config, contents=contents
+        ):
+            if chunk.text:
+                yield chunk.text
+
+
+model_client = GeminiClient(
+    Config.GEMINI_API_KEY,
+    Config.GEMINI_MODEL,
+    Config.GEMINI_BASE_URL,
+    Config.ASSISTANT_MAX_CONCURRENCY,
+)
+
+
+def set_model_client(client):
+    """
+    Sustituye el cliente por cualquier objeto con generate(contents) y
+    stream(contents).
+    """
+    global model_client
+    model_client = client
+
+
+def generate_reply(contents):
+    return model_client.generate(contents)
+
+
+def stream_reply(contents):
+    return model_client.stream(contents)
+
+
+# Límite de llamadas simultáneas al modelo por proceso
+_slots = BoundedSemaphore(Config.ASSISTANT_MAX_CONCURRENCY)
+
+
+def acquire_slot():
+    return _slots.acquire(timeout=Config.ASSISTANT_QUEUE_TIMEOUT)
+
+
+def release_slot():
+    _slots.release()
+
+
+def message_content(role, text):
+    return {"role": role, "parts": [{"text": text}]}
+
+
+def estimate_tokens(text):
+    # Aproximación de unos 4 caracteres por token; contar los tokens exactos
+    # costaría otra llamada a la API
+    return len(text) // 4 + 1
+
+
+def _summarize(dropped):
+    """
+    Resume sin llamar al modelo los mensajes que no caben: se quedan las
+    preguntas más recientes del usuario, recortadas, hasta llenar el
+    presupuesto del resumen.
+    """
+    questions = []
+    used = 0
+    for content in reversed(dropped):
+        if content["role"] != "user":
+            continue
+        question = " ".join(content["parts"][0]["text"].split())[:120]
+        tokens = estimate_tokens(question)
+        if used + tokens > Config.ASSISTANT_SUMMARY_TOKENS:
+            break
+        questions.append(question)
+        used += tokens
+    if not questions:
+        return None
+    return "Antes el usuario preguntó por: " + "; ".join(reversed(questions))
+
+
+def trim_contents(contents):
+    """
+    Recorta el historial a ASSISTANT_HISTORY_TOKENS tokens estimados, quitando
+    los mensajes más antiguos. El último mensaje se envía siempre y lo que se
+    quita se resume delante del primer mensaje que queda.
+    """
+    used = 0
+    start = len(contents)
+    while start > 0:
+        tokens = estimate_tokens(contents[start - 1]["parts"][0]["text"])
+        if start < len(contents) and used + tokens > Config.ASSISTANT_HISTORY_TOKENS:
+            break
+        used += tokens
+        start -= 1
+
+    # El historial tiene que seguir empezando por un mensaje del usuario
+    while start < len(contents) - 1 and contents[start]["role"] != "user":
+        start += 1
+    if start == 0:
+        return contents
+
+    kept = contents[start:]
+    summary = _summarize(contents[:start])
+    if summary:
+        first = kept[0]
+        kept[0] = message_content(
+            first["role"], f"{summary}\n\n{first['parts'][0]['text']}"
+        )
+    return kept
+
+
+class ReplyCache:
+    """
+    Caché LRU con caducidad de las respuestas del modelo. Evita repetir la
+    llamada cuando llega la misma pregunta con el mismo contexto reciente.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl.total_seconds()
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, text):
+        if self.max_entries <= 0 or not text:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, text)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+reply_cache = ReplyCache(Config.ASSISTANT_CACHE_ENTRIES, Config.ASSISTANT_CACHE_TTL)
+
+
+def _normalize(text):
+    # Sin tildes: "cómo" y "como" son la misma pregunta
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(text.split()).strip("¿?¡!. ")
+
+
+def reply_cache_key(contents):
+    """
+    Clave de la caché: modelo, instrucciones del sistema y los últimos
+    mensajes normalizados (minúsculas, tildes, espacios y signos finales).
+    """
+    window = [
+        [content["role"], _normalize(content["parts"][0]["text"])]
+        for content in contents[-Config.ASSISTANT_CACHE_CONTEXT :]
+    ]
+    payload = json.dumps(
+        [getattr(model_client, "model", None), SYSTEM_INSTRUCTION, window],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def conversation_contents(conversation_id):
+    """
+    Devuelve el historial de la conversación listo para el modelo. Los mensajes
+    seguidos del mismo rol (una respuesta que se cortó) se juntan en uno.
+    """
+    messages = (
+        db.session.query(ConversationMessage.role, ConversationMessage.content)
+        .filter(ConversationMessage.conversation_id == conversation_id)
+        .order_by(ConversationMessage.id.desc())
+        .limit(Config.ASSISTANT_MAX_HISTORY)
+        .all()
+    )
+
+    contents = []
+    for role, text in reversed(messages):
+        if contents and contents[-1]["role"] == role:
+            contents[-1]["parts"][0]["text"] += "\n\n" + text
+        else:
+            contents.append(message_content(role, text))
+
+    # El historial tiene que empezar por un mensaje del usuario
+    while contents and contents[0]["role"] != "user":
+        contents.pop(0)
+    return contents
+
+
+def add_message(conversation_id, role, text):
+    db.session.add(
+        ConversationMessage(conversation_id=conversation_id, role=role, content=text)
+    )
+    db.session.query(Conversation).filter(Conversation.id == conversation_id).update(
+        {"updated_date": datetime.now()}
+    )
+
+
+def expire_conversations():
+    limit = datetime.now() - Config.ASSISTANT_CONVERSATION_EXPIRES
+    expired = db.session.query(Conversation.id).filter(
+        Conversation.updated_date < limit
+    )
+    db.session.query(ConversationMessage).filter(
+        ConversationMessage.conversation_id.in_(expired)
+    ).delete(synchronize_session=False)
+    db.session.query(Conversation).filter(Conversation.updated_date < limit).delete(
+        synchronize_session=False
+    )
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
@@ -0,0 +1,91 @@
+import io
+import traceback
+
+from sqlalchemy import func, or_, select, update
+
+from models import db, Rom, RomBlob
+from utils import blob_relative_path, store_blob_streaming
+from storage import user_storage
+from rom_metadata import read_rom_metadata, scan_rom
+
+
+def _legacy_blob(rom):
+    """
+    Lee la ROM de su ruta antigua, la guarda en el almacén de blobs y devuelve
+    el RomBlob sin añadir a la sesión, o None si el fichero ya no existe.
+    """
+    if not user_storage.exists(rom.path):
+        return None
+
+    file = io.BytesIO(user_storage.read(rom.path))
+    metadata = read_rom_metadata(file, rom.name) or {}
+    scanner = scan_rom(file)
+    metadata["save_type"] = metadata.get("save_type") or scanner.save_type or "none"
+    metadata["crc32"] = scanner.crc32
+
+    rom_hash = scanner.hexdigest()
+    store_blob_streaming(file, rom_hash)
+    return RomBlob(
+        hash=rom_hash,
+        size=scanner.size,
+        path=blob_relative_path(rom_hash),
+        ref_count=0,
+        **metadata,
+    )
+
+
+def backfill_rom_blobs():
+    """
+    Pasa al almacén de blobs las ROMs subidas antes de que existiera, que
+    siguen en <usuario>/roms/<nombre>, y recalcula ref_count de todos los blobs.
+    Se puede repetir sin riesgo. Devuelve (migradas, sin fichero).
+    """
+    legacy_roms = (
+        Rom.query.outerjoin(RomBlob, RomBlob.hash == Rom.hash)
+        .filter(or_(RomBlob.id.is_(None), Rom.path != RomBlob.path))
+        .order_by(Rom.id)
+        .all()
+    )
+
+    migrated = 0
+    lost = 0
+    for rom in legacy_roms:
+        legacy_path = rom.path
+        try:
+            blob = db.session.query(RomBlob).filter_by(hash=rom.hash).first()
+            if blob is None:
+                blob = _legacy_blob(rom)
+                if blob is None:
+                    print(f"ROM {rom.id} sin fichero en {legacy_path}")
+                    lost += 1
+                    continue
+                # Si el fichero no coincide con el hash guardado manda el contenido
+                existing = RomBlob.query.filter_by(hash=blob.hash).first()
+                if existing is None:
+                    db.session.add(blob)
+                else:
+                    blob = existing
+                rom.hash = blob.hash
+                rom.size = blob.size
+
+            rom.path = blob.path
+            db.session.commit()
+            migrated += 1
+        except Exception:
+            traceback.print_exc()
+            db.session.rollback()
+            continue
+
+        # El fichero antiguo solo se borra cuando la fila ya apunta al blob
+        if legacy_path != rom.path:
+            user_storage.delete(legacy_path)
+
+    db.session.execute(
+        update(RomBlob).values(
+            ref_count=select(func.count(Rom.id))
+            .where(Rom.hash == RomBlob.hash)
+            .scalar_subquery()
+        )
+    )
+    db.session.commit()
+    return migrated, lost
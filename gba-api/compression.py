@@ -0,0 +1,156 @@
+import os
+import uuid
+import zlib
+import traceback
+from threading import Lock
+
+from config import Config
+from runtime import native_executor, run_in_background
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class _GzipCompressor:
+    def __init__(self):
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+class _BrotliCompressor:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=9)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+class _ZstdCompressor:
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=19).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+# Orden de preferencia del servidor: la codificación que mejor comprime primero
+ENCODINGS = {}
+if brotli is not None:
+    ENCODINGS["br"] = (".br", _BrotliCompressor)
+if zstandard is not None:
+    ENCODINGS["zstd"] = (".zst", _ZstdCompressor)
+ENCODINGS["gzip"] = (".gz", _GzipCompressor)
+
+_executor = native_executor(1, "compression")
+_pending = set()
+_pending_lock = Lock()
+
+
+def variant_path(file_path, encoding):
+    return file_path + ENCODINGS[encoding][0]
+
+
+def build_variant(file_path, encoding, chunk_size=65536):
+    target_path = variant_path(file_path, encoding)
+    temp_path = f"{target_path}.{uuid.uuid4().hex}.part"
+    compressor = ENCODINGS[encoding][1]()
+
+    # El blob puede haberse borrado mientras la tarea esperaba en la cola
+    if not os.path.isfile(file_path):
+        return
+
+    try:
+        with open(file_path, "rb") as source, open(temp_path, "wb") as target:
+            while True:
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    break
+                target.write(compressor.compress(chunk))
+            target.write(compressor.flush())
+        os.replace(temp_path, target_path)
+        if not os.path.isfile(file_path):
+            os.remove(target_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _build_variant_task(file_path, encoding):
+    try:
+        build_variant(file_path, encoding)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        with _pending_lock:
+            _pending.discard((file_path, encoding))
+
+
+def schedule_compression(file_path, encodings=None):
+    """
+    Genera en segundo plano las variantes comprimidas que aún no existen.
+    """
+    if not Config.PRECOMPRESS_ROMS:
+        return
+
+    for encoding in encodings or ENCODINGS:
+        if os.path.isfile(variant_path(file_path, encoding)):
+            continue
+        with _pending_lock:
+            if (file_path, encoding) in _pending:
+                continue
+            _pending.add((file_path, encoding))
+        run_in_background(_executor, _build_variant_task, file_path, encoding)
+
+
+def select_variant(file_path, accept_encodings):
+    """
+    Devuelve (ruta, codificación) de la mejor variante aceptada por el cliente,
+    o (file_path, None) si no hay ninguna que merezca la pena todavía.
+    """
+    if not Config.PRECOMPRESS_ROMS:
+        return file_path, None
+
+    accepted = [encoding for encoding in ENCODINGS if accept_encodings[encoding] > 0]
+    if not accepted:
+        return file_path, None
+
+    file_size = os.path.getsize(file_path)
+    selected = (file_path, None)
+    missing = []
+    for encoding in accepted:
+        path = variant_path(file_path, encoding)
+        if not os.path.isfile(path):
+            missing.append(encoding)
+        elif selected[1] is None and (
+            os.path.getsize(path) <= file_size * Config.COMPRESSION_MIN_RATIO
+        ):
+            selected = (path, encoding)
+
+    if missing:
+        schedule_compression(file_path, missing)
+    return selected
+
+
+def remove_variants(file_path):
+    for encoding in ENCODINGS:
+        path = variant_path(file_path, encoding)
+        if os.path.isfile(path):
+            os.remove(path)
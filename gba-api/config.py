@@ -13,7 +13,123 @@ class Config:
     JWT_COOKIE_SAMESITE = "Lax"
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(hours=1)
     JWT_COOKIE_DOMAIN = os.getenv("JWT_COOKIE_DOMAIN")
+    # Hash de contraseñas: "argon2" (argon2id) o "werkzeug" con
+    # PASSWORD_WERKZEUG_METHOD. Las guardadas con otro esquema o con otros
+    # parámetros se rehacen al iniciar sesión
+    PASSWORD_SCHEME = os.getenv("PASSWORD_SCHEME", "argon2")
+    ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", 2))
+    # KiB por hash
+    ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", 19456))
+    ARGON2_PARALLELISM = int(os.getenv("ARGON2_PARALLELISM", 1))
+    PASSWORD_WERKZEUG_METHOD = os.getenv("PASSWORD_WERKZEUG_METHOD", "scrypt")
+    # Hashes que se calculan a la vez por worker
+    PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 4))
     SQLALCHEMY_DATABASE_URI = os.getenv("DB_URL")
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Réplica de solo lectura para las rutas marcadas con use_replica
+    DB_REPLICA_URL = os.getenv("DB_REPLICA_URL")
+    SQLALCHEMY_BINDS = {"replica": DB_REPLICA_URL} if DB_REPLICA_URL else {}
+    # Conexiones a Postgres por worker. Con gevent un worker atiende muchas
+    # peticiones a la vez y DB_POOL_SIZE + DB_MAX_OVERFLOW es el máximo que
+    # abre; el resto espera hasta DB_POOL_TIMEOUT segundos
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+    DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", 30))
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+    DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true") == "true"
+    # Milisegundos que puede durar una sentencia en el servidor (0 sin límite)
+    DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", 30000))
+    # Sentencias compiladas que SQLAlchemy guarda por engine
+    DB_QUERY_CACHE_SIZE = 1000
+    # Conexión a través de PgBouncer en modo transacción: sin pool propio y con
+    # el timeout fijado en cada transacción
+    DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "false") == "true"
     ROM_FOLDER = os.path.join(os.getcwd(), "uploads", "users")
+    BLOB_FOLDER = os.path.join(os.getcwd(), "uploads", "blobs")
+    STAGING_FOLDER = os.path.join(BLOB_FOLDER, ".staging")
+    # local: ROM_FOLDER y BLOB_FOLDER en disco, s3: bucket compatible con S3.
+    # Con s3 las subidas se preparan igualmente en STAGING_FOLDER
+    STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")
+    S3_BUCKET = os.getenv("S3_BUCKET")
+    S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+    S3_REGION = os.getenv("S3_REGION", "us-east-1")
+    S3_ACCESS_KEY_ID = os.getenv("S3_ACCESS_KEY_ID")
+    S3_SECRET_ACCESS_KEY = os.getenv("S3_SECRET_ACCESS_KEY")
+    S3_ADDRESSING_STYLE = os.getenv("S3_ADDRESSING_STYLE", "path")
+    S3_MAX_CONNECTIONS = 32
+    # Con S3 las descargas redirigen a una URL firmada en lugar de pasar por Flask
+    S3_PRESIGNED_DOWNLOADS = os.getenv("S3_PRESIGNED_DOWNLOADS", "true") == "true"
+    S3_PRESIGN_EXPIRES = timedelta(minutes=15)
+    # stream: generador de Python, sendfile: wsgi.file_wrapper (os.sendfile en
+    # gunicorn), accel: X-Accel-Redirect para que nginx envíe el fichero
+    FILE_SERVING_BACKEND = os.getenv("FILE_SERVING_BACKEND", "stream")
+    ACCEL_REDIRECT_LOCATIONS = {
+        BLOB_FOLDER: "/internal/blobs/",
+        ROM_FOLDER: "/internal/users/",
+    }
+    PRECOMPRESS_ROMS = True
+    # Presupuesto en bytes de la caché de ROMs por worker (0 la desactiva). Solo
+    # se usa cuando Python envía los bytes: stream local o S3 sin URL firmada
+    ROM_CACHE_BYTES = int(os.getenv("ROM_CACHE_BYTES", 256 * 1024 * 1024))
+    COMPRESSION_MIN_RATIO = 0.9
+    MIN_ROM_SIZE = 32 * 1024
+    MAX_ROM_SIZE = 32 * 1024 * 1024
+    MAX_ROM_BATCH = 1000
+    # Werkzeug admite 1000 partes por formulario; un lote completo lleva una ROM
+    # y una partida por juego además de los campos
+    MAX_FORM_PARTS = 2 * MAX_ROM_BATCH + 16
+    # Reto de /api/checkroms: rangos de la ROM que el cliente firma para
+    # demostrar que la tiene antes de vincular un blob ya subido por otro
+    ROM_CHALLENGE_RANGES = 4
+    ROM_CHALLENGE_RANGE_SIZE = 4096
+    ROM_CHALLENGE_TTL = 600
+    INGEST_WORKERS = 4
+    INGEST_JOB_WORKERS = 2
+    ROM_PAGE_SIZE = 100
+    MAX_ROM_PAGE_SIZE = 500
+    MAX_SAVE_SIZE = 4 * 1024 * 1024
+    # Bytes de ROMs y partidas por usuario (0 la desactiva)
+    STORAGE_QUOTA = int(os.getenv("STORAGE_QUOTA", 2 * 1024 * 1024 * 1024))
+    SAVE_DELTA_BLOCK_SIZE = 256
+    SAVE_REBASE_RATIO = 0.5
+    SAVE_MAX_DELTAS = 32
+    UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+    UPLOAD_SESSION_EXPIRES = timedelta(hours=24)
     GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+    GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+    # Permite apuntar el cliente a un servidor compatible, por ejemplo uno falso
+    # para pruebas
+    GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL")
+    ASSISTANT_MAX_CONCURRENCY = int(os.getenv("ASSISTANT_MAX_CONCURRENCY", 8))
+    ASSISTANT_QUEUE_TIMEOUT = int(os.getenv("ASSISTANT_QUEUE_TIMEOUT", 5))
+    ASSISTANT_MAX_HISTORY = 40
+    ASSISTANT_CONVERSATION_EXPIRES = timedelta(days=7)
+    # Tokens estimados del historial que se envía al modelo. Lo que no cabe se
+    # resume en un párrafo de como mucho ASSISTANT_SUMMARY_TOKENS
+    ASSISTANT_HISTORY_TOKENS = int(os.getenv("ASSISTANT_HISTORY_TOKENS", 4000))
+    ASSISTANT_SUMMARY_TOKENS = 300
+    # Caché de respuestas por worker (0 entradas la desactiva). La clave incluye
+    # los últimos ASSISTANT_CACHE_CONTEXT mensajes, contando la pregunta
+    ASSISTANT_CACHE_ENTRIES = int(os.getenv("ASSISTANT_CACHE_ENTRIES", 1024))
+    ASSISTANT_CACHE_TTL = timedelta(hours=1)
+    ASSISTANT_CACHE_CONTEXT = 3
+    # Límite de peticiones por usuario (o por IP sin sesión) con un cubo de
+    # fichas: (ráfaga, segundos en recargarse entero). "memory" cuenta en cada
+    # worker; "redis" comparte los cubos entre workers y servidores con
+    # cualquier servidor que hable el protocolo de Redis. "none" lo desactiva
+    RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+    REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    # Proxies de confianza delante de la API (nginx en docker compose). La IP
+    # del cliente se toma de X-Forwarded-For; con 0 se usa la de la conexión
+    PROXY_COUNT = int(os.getenv("PROXY_COUNT", 0))
+    RATE_LIMITS = {
+        "assistant": (10, 60),
+        "upload": (30, 300),
+        "download": (120, 60),
+    }
+    # /metrics pide la cabecera "Authorization: Bearer <token>"; sin token
+    # la ruta está desactivada
+    METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+    # Fracción de peticiones que se perfilan con pyinstrument (0 lo desactiva)
+    PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+    PROFILE_FOLDER = os.path.join(os.getcwd(), "profiles")
@@ -0,0 +1,91 @@
+from functools import wraps
+
+from flask import g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
+
+from config import Config
+
+
+def engine_options(database_url):
+    """
+    Opciones del engine para Postgres. Con SQLite se dejan las de Flask-SQLAlchemy.
+    """
+    if not database_url:
+        return {}
+    url = make_url(database_url)
+    if url.get_backend_name() != "postgresql":
+        return {}
+
+    options = {
+        "pool_pre_ping": Config.DB_POOL_PRE_PING,
+        "query_cache_size": Config.DB_QUERY_CACHE_SIZE,
+    }
+    if Config.DB_PGBOUNCER:
+        # PgBouncer ya reparte las conexiones y en modo transacción no admite
+        # parámetros de arranque, el timeout se fija en cada transacción
+        options["poolclass"] = NullPool
+        if url.get_driver_name() == "psycopg":
+            # psycopg 3 prepara en el servidor las sentencias repetidas y en
+            # modo transacción la siguiente puede caer en otra conexión
+            options["connect_args"] = {"prepare_threshold": None}
+    else:
+        options.update(
+            pool_size=Config.DB_POOL_SIZE,
+            max_overflow=Config.DB_MAX_OVERFLOW,
+            pool_timeout=Config.DB_POOL_TIMEOUT,
+            pool_recycle=Config.DB_POOL_RECYCLE,
+        )
+        if Config.DB_STATEMENT_TIMEOUT:
+            options["connect_args"] = {
+                "options": f"-c statement_timeout={Config.DB_STATEMENT_TIMEOUT}"
+            }
+    return options
+
+
+class RoutingSession(Session):
+    """
+    Sesión que manda las lecturas de las rutas marcadas con use_replica a la
+    réplica. Las escrituras y los flush siguen yendo a la base de datos principal.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (
+            bind is None
+            and has_app_context()
+            and g.get("use_replica")
+            and not self._flushing
+            and not getattr(clause, "is_dml", False)
+        ):
+            engine = self._db.engines.get("replica")
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, "after_begin")
+def set_statement_timeout(session, transaction, connection):
+    if (
+        Config.DB_PGBOUNCER
+        and Config.DB_STATEMENT_TIMEOUT
+        and connection.dialect.name == "postgresql"
+    ):
+        connection.exec_driver_sql(
+            f"SET LOCAL statement_timeout = {Config.DB_STATEMENT_TIMEOUT}"
+        )
+
+
+def use_replica(function):
+    """
+    Lee de la réplica (DB_REPLICA_URL) durante la petición. Solo para rutas que
+    toleran unos segundos de retraso respecto a la principal.
+    """
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        g.use_replica = True
+        return function(*args, **kwargs)
+
+    return wrapper
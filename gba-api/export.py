@@ -0,0 +1,109 @@
+import os
+import zlib
+import hashlib
+
+from sqlalchemy import func
+
+from models import db, Rom, RomBlob, Save
+from utils import blob_relative_path
+from storage import blob_storage
+from save_versions import load_save_data
+from archive import StoredEntry
+
+
+def _storage_reader(storage, key):
+    def read(start, end):
+        return storage.read_range(key, start, end)
+
+    return read
+
+
+def _save_reader(save):
+    def read(start, end):
+        yield load_save_data(save)[start:end]
+
+    return read
+
+
+def _stored_crc32(storage, key, size):
+    crc = 0
+    for chunk in storage.read_range(key, 0, size):
+        crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def _archive_name(folder, name, suffix, used):
+    name = os.path.basename(name.replace("\\", "/")) or suffix
+    path = f"{folder}/{name}"
+    if path in used:
+        stem, extension = os.path.splitext(name)
+        path = f"{folder}/{stem}-{suffix}{extension}"
+    used.add(path)
+    return path
+
+
+def build_library_export(user_id):
+    """
+    Devuelve las entradas del zip con las ROMs del usuario y la última partida
+    de cada tipo por ROM. Los blobs anteriores al CRC guardado se calculan una
+    vez y se guardan.
+    """
+    roms = (
+        db.session.query(Rom, RomBlob)
+        .join(RomBlob, RomBlob.hash == Rom.hash)
+        .filter(Rom.user_id == user_id)
+        .order_by(Rom.id)
+        .all()
+    )
+
+    pending = {blob.hash: blob for _, blob in roms if blob.crc32 is None}
+    for blob in pending.values():
+        blob.crc32 = _stored_crc32(
+            blob_storage, blob_relative_path(blob.hash), blob.size
+        )
+    if pending:
+        db.session.commit()
+
+    used = set()
+    entries = []
+    for rom, blob in roms:
+        entries.append(
+            StoredEntry(
+                _archive_name("roms", rom.name, rom.hash[:8], used),
+                blob.size,
+                blob.crc32,
+                rom.upload_date,
+                _storage_reader(blob_storage, blob_relative_path(blob.hash)),
+            )
+        )
+
+    latest_ids = (
+        db.session.query(func.max(Save.id))
+        .filter(Save.user_id == user_id)
+        .group_by(Save.rom_id, Save.kind)
+    )
+    saves = Save.query.filter(Save.id.in_(latest_ids)).order_by(Save.id).all()
+    for save in saves:
+        # Las partidas son pequeñas: se reconstruyen para calcular el CRC y se
+        # vuelven a reconstruir al enviarlas
+        data = load_save_data(save)
+        entries.append(
+            StoredEntry(
+                _archive_name("saves", save.name, str(save.id), used),
+                len(data),
+                zlib.crc32(data),
+                save.upload_date,
+                _save_reader(save),
+            )
+        )
+
+    return entries
+
+
+def export_etag(entries):
+    digest = hashlib.sha256()
+    for entry in entries:
+        digest.update(
+            f"{entry.name}:{entry.size}:{entry.crc}:{entry.date_time}\n".encode()
+        )
+    return digest.hexdigest()[:32]
@@ -0,0 +1,41 @@
+import os
+import shutil
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", 4))
+
+# Modo de servicio:
+# - "gevent": cada conexión es una corutina, así las descargas lentas y las
+#   esperas al asistente no ocupan el worker y cada uno atiende hasta
+#   WORKER_CONNECTIONS a la vez.
+# - "gthread": WORKER_THREADS hilos por worker.
+# - "sync": una petición por worker, como antes.
+worker_class = os.getenv("SERVER_MODE", "gevent")
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", 1000))
+# Con threads > 1 gunicorn cambia sync por gthread, solo se usa en ese modo
+threads = int(os.getenv("WORKER_THREADS", 32)) if worker_class == "gthread" else 1
+
+# Cada worker escribe sus métricas en este directorio y /metrics las suma. Se
+# fija antes de cargar la aplicación para que prometheus_client lo detecte
+metrics_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/gba-metrics")
+
+
+def on_starting(server):
+    # Los ficheros de un arranque anterior sumarían valores de procesos muertos
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def post_fork(server, worker):
+    # psycopg2 bloquea el worker entero mientras espera a Postgres salvo que
+    # se le indique que ceda el control a gevent
+    if worker_class == "gevent":
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,469 @@
+import os
+import uuid
+import shutil
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from sqlalchemy import update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from config import Config
+from models import db, Rom, RomBlob, IngestJob
+from utils import (
+    allowed_file,
+    store_blob_streaming,
+    blob_relative_path,
+    schedule_blob_compression,
+    save_file_streaming,
+)
+from save_versions import store_save_version
+from quota import (
+    QuotaExceededError,
+    reserve_storage,
+    release_storage,
+    storage_remaining,
+)
+from storage import blob_storage
+from rom_metadata import (
+    HEADER_SIZE,
+    RomScanner,
+    parse_rom_header,
+    read_rom_metadata,
+    scan_rom,
+)
+from archive import iter_zip_entries
+from runtime import native_executor
+from metrics import observe_hash
+
+# Hashes y escritura de blobs en hilos del sistema; los trabajos en segundo
+# plano solo esperan a la base de datos y a este pool
+_io_executor = native_executor(Config.INGEST_WORKERS, "ingest-io")
+_job_executor = ThreadPoolExecutor(
+    max_workers=Config.INGEST_JOB_WORKERS, thread_name_prefix="ingest-job"
+)
+
+
+def _scan_rom(rom):
+    try:
+        # La cabecera se comprueba antes de leer el resto del fichero
+        metadata = read_rom_metadata(rom["file"], rom["name"])
+        if metadata is None:
+            return None, None
+        scanner = scan_rom(rom["file"])
+        if metadata["save_type"] is None:
+            metadata["save_type"] = scanner.save_type or "none"
+        metadata["crc32"] = scanner.crc32
+        return scanner.hexdigest(), metadata
+    except Exception:
+        traceback.print_exc()
+        return None, None
+
+
+def _store_rom(item):
+    rom_hash, rom = item
+    try:
+        if rom.get("path"):
+            # En local los ficheros preparados ya están en el volumen del
+            # almacén y basta con renombrarlos
+            blob_storage.move(blob_relative_path(rom_hash), rom["path"])
+        else:
+            store_blob_streaming(rom["file"], rom_hash)
+        return True
+    except Exception:
+        traceback.print_exc()
+        return False
+
+
+def ingest_roms(user_id, roms, progress=None):
+    """
+    Registra un lote de ROMs para el usuario. Los hashes y la escritura de los
+    blobs nuevos se hacen en paralelo y los duplicados se resuelven con una
+    consulta IN por tabla. Cada ROM es un diccionario con name, size, file y,
+    si ya está en disco, path. Los ficheros sin una cabecera de cartucho válida
+    se descartan. Devuelve nombre -> id y las ROMs nuevas.
+    """
+    batch = {}
+    for processed, (rom, (rom_hash, metadata)) in enumerate(
+        zip(roms, _io_executor.map(_scan_rom, roms)), start=1
+    ):
+        if rom_hash:
+            batch.setdefault(rom_hash, dict(rom, metadata=metadata))
+        if progress:
+            progress(processed)
+
+    return register_roms(user_id, batch)
+
+
+def insert_rom_blobs(rows):
+    """
+    Inserta los blobs (diccionarios con las columnas de RomBlob) y devuelve
+    hash -> RomBlob con la fila bloqueada. Si otra petición acaba de insertar
+    el mismo hash no se produce un error de unicidad: se usa su fila, que
+    apunta al mismo contenido.
+    """
+    if not rows:
+        return {}
+
+    if db.engine.dialect.name == "postgresql":
+        statement = postgresql_insert(RomBlob)
+    else:
+        statement = sqlite_insert(RomBlob)
+    db.session.execute(statement.on_conflict_do_nothing(index_elements=["hash"]), rows)
+
+    return {
+        blob.hash: blob
+        for blob in RomBlob.query.filter(
+            RomBlob.hash.in_([row["hash"] for row in rows])
+        )
+        .with_for_update()
+        .populate_existing()
+    }
+
+
+def register_roms(user_id, batch):
+    """
+    Da de alta las ROMs ya hasheadas (hash -> diccionario con name, size,
+    metadata y file o path), guardando solo los blobs que aún no existen.
+    """
+    if not batch:
+        return {}, []
+
+    owned = db.session.query(Rom.hash, Rom.name, Rom.id).filter(
+        Rom.user_id == user_id, Rom.hash.in_(batch)
+    )
+    rom_ids = {}
+    for rom_hash, rom_name, rom_id in owned:
+        rom_ids[rom_name] = rom_id
+        batch.pop(rom_hash, None)
+
+    # La cuota se reserva antes de escribir ningún blob
+    reserve_storage(user_id, sum(rom["size"] for rom in batch.values()))
+
+    blobs = {
+        blob.hash: blob
+        for blob in RomBlob.query.filter(RomBlob.hash.in_(batch)).with_for_update()
+    }
+    for rom_hash, blob in blobs.items():
+        # Blobs guardados antes de indexar las cabeceras
+        if blob.platform is None or blob.crc32 is None:
+            for key, value in batch[rom_hash]["metadata"].items():
+                setattr(blob, key, value)
+
+    missing = [
+        (rom_hash, rom) for rom_hash, rom in batch.items() if rom_hash not in blobs
+    ]
+    new_blobs = []
+    for (rom_hash, rom), stored in zip(missing, _io_executor.map(_store_rom, missing)):
+        if not stored:
+            batch.pop(rom_hash)
+            release_storage(user_id, rom["size"])
+            continue
+        new_blobs.append(
+            dict(
+                hash=rom_hash,
+                size=rom["size"],
+                path=blob_relative_path(rom_hash),
+                ref_count=0,
+                **rom["metadata"],
+            )
+        )
+    blobs.update(insert_rom_blobs(new_blobs))
+
+    new_roms = []
+    for rom_hash, rom in batch.items():
+        blob = blobs[rom_hash]
+        blob.ref_count += 1
+        new_roms.append(
+            Rom(
+                name=rom["name"],
+                hash=rom_hash,
+                size=rom["size"],
+                path=blob.path,
+                user_id=user_id,
+            )
+        )
+
+    db.session.add_all(new_roms)
+    db.session.flush()
+    for rom in new_roms:
+        rom_ids[rom.name] = rom.id
+
+    return rom_ids, new_roms
+
+
+def _match_save_rom(save_name, batch_roms, owned_roms):
+    """
+    Busca la ROM de la partida: primero la de nombre idéntico sin extensión,
+    antes en el lote que en la biblioteca; si no la hay, la única cuyo nombre
+    empieza igual. Con varias candidatas no se asocia a ninguna.
+    """
+    base_save_name = os.path.splitext(save_name)[0]
+    for roms in (batch_roms, owned_roms):
+        for rom_name, rom_id in roms.items():
+            if os.path.splitext(rom_name)[0] == base_save_name:
+                return rom_id
+
+    for roms in (batch_roms, {**owned_roms, **batch_roms}):
+        matching = [
+            rom_id
+            for rom_name, rom_id in roms.items()
+            if rom_name.startswith(base_save_name)
+        ]
+        if len(matching) == 1:
+            return matching[0]
+        if matching:
+            return None
+    return None
+
+
+def ingest_saves(user_id, rom_ids, saves):
+    """
+    Asocia cada partida a su ROM (ver _match_save_rom), incluyendo las ROMs
+    que el usuario ya tenía.
+    """
+    owned_roms = dict(db.session.query(Rom.name, Rom.id).filter(Rom.user_id == user_id))
+
+    new_saves = []
+    for save_name, save_file in saves:
+        try:
+            rom_id = _match_save_rom(save_name, rom_ids, owned_roms)
+            if rom_id is None:
+                continue
+
+            data = save_file.read(Config.MAX_SAVE_SIZE + 1)
+            if len(data) > Config.MAX_SAVE_SIZE:
+                continue
+
+            new_save = store_save_version(user_id, rom_id, save_name, data)
+            db.session.add(new_save)
+            new_saves.append(new_save)
+        except QuotaExceededError:
+            raise
+        except Exception:
+            traceback.print_exc()
+
+    return new_saves
+
+
+def _stage_archive_rom(entry, name, path):
+    """
+    Escribe una ROM del archivo en el área de preparación a medida que se
+    descomprime. Devuelve None si no cabe en los límites o no es una ROM.
+    """
+    scanner = RomScanner()
+    header = b""
+    size = 0
+    valid = True
+    with open(path, "wb") as f:
+        for chunk in entry.chunks():
+            size += len(chunk)
+            if not valid:
+                # Hay que seguir descomprimiendo para llegar a la siguiente entrada
+                continue
+            if size > Config.MAX_ROM_SIZE:
+                valid = False
+                continue
+            if len(header) < HEADER_SIZE:
+                header += chunk[: HEADER_SIZE - len(header)]
+                if len(header) == HEADER_SIZE and not parse_rom_header(header, name):
+                    valid = False
+                    continue
+            scanner.update(chunk)
+            f.write(chunk)
+
+    observe_hash("archive", scanner.size, scanner.seconds)
+    metadata = parse_rom_header(header, name) if valid else None
+    if size < Config.MIN_ROM_SIZE or metadata is None:
+        os.remove(path)
+        return None
+
+    if metadata["save_type"] is None:
+        metadata["save_type"] = scanner.save_type or "none"
+    metadata["crc32"] = scanner.crc32
+    return scanner.hexdigest(), {
+        "name": name,
+        "size": size,
+        "path": path,
+        "metadata": metadata,
+    }
+
+
+def _owned_rom(user_id, rom_hash):
+    return (
+        db.session.query(Rom.id).filter_by(user_id=user_id, hash=rom_hash).first()
+        is not None
+    )
+
+
+def _stage_archive_save(entry, path):
+    """
+    Escribe una partida del archivo en el área de preparación. Devuelve False
+    si pasa de MAX_SAVE_SIZE.
+    """
+    size = 0
+    with open(path, "wb") as f:
+        for chunk in entry.chunks():
+            size += len(chunk)
+            if size <= Config.MAX_SAVE_SIZE:
+                f.write(chunk)
+
+    if size > Config.MAX_SAVE_SIZE:
+        os.remove(path)
+        return False
+    return True
+
+
+def import_rom_archive(user_id, stream):
+    """
+    Importa las ROMs y partidas (.sav) de un zip leyendo el stream entrada a
+    entrada. Como mucho se toman MAX_ROM_BATCH de cada tipo y todo se prepara
+    en disco. Devuelve las ROMs nuevas y los nombres de las entradas descartadas.
+    """
+    staging_dir = os.path.join(Config.STAGING_FOLDER, "import-" + uuid.uuid4().hex)
+    os.makedirs(staging_dir, exist_ok=True)
+    batch = {}
+    saves = []
+    save_files = []
+    opened = []
+    skipped = []
+    # Se deja de leer el archivo en cuanto las ROMs nuevas no caben en la cuota
+    remaining = storage_remaining(user_id)
+    staged_size = 0
+
+    try:
+        for index, entry in enumerate(iter_zip_entries(stream)):
+            name = os.path.basename(entry.name)
+            if entry.is_dir or not name:
+                continue
+
+            if allowed_file(name) and len(batch) < Config.MAX_ROM_BATCH:
+                staged = _stage_archive_rom(
+                    entry, name, os.path.join(staging_dir, str(index))
+                )
+                if staged and _owned_rom(user_id, staged[0]):
+                    os.remove(staged[1]["path"])
+                elif staged and staged[0] not in batch:
+                    staged_size += staged[1]["size"]
+                    if remaining is not None and staged_size > remaining:
+                        raise QuotaExceededError(
+                            Config.STORAGE_QUOTA - remaining, Config.STORAGE_QUOTA
+                        )
+                    batch[staged[0]] = staged[1]
+                elif staged:
+                    os.remove(staged[1]["path"])
+                else:
+                    skipped.append(name)
+            elif name.lower().endswith(".sav") and len(saves) < Config.MAX_ROM_BATCH:
+                save_path = os.path.join(staging_dir, f"{index}.sav")
+                if _stage_archive_save(entry, save_path):
+                    saves.append((name, save_path))
+                else:
+                    skipped.append(name)
+            else:
+                skipped.append(name)
+
+        rom_ids, new_roms = register_roms(user_id, batch)
+        for save_name, save_path in saves:
+            save_file = open(save_path, "rb")
+            opened.append(save_file)
+            save_files.append((save_name, save_file))
+        if save_files:
+            ingest_saves(user_id, rom_ids, save_files)
+        return new_roms, skipped
+    finally:
+        for file in opened:
+            file.close()
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def stage_files(job_id, files):
+    staging_dir = os.path.join(Config.STAGING_FOLDER, job_id)
+    staged = []
+    for index, file in enumerate(files):
+        path = os.path.join(staging_dir, str(index))
+        save_file_streaming(file, path)
+        staged.append(path)
+    return staged
+
+
+def update_job(job_id, **values):
+    # Conexión propia para que el progreso se vea sin confirmar la ingesta
+    with db.engine.begin() as connection:
+        connection.execute(
+            update(IngestJob).where(IngestJob.id == job_id).values(**values)
+        )
+
+
+def start_ingest_job(app, user_id, roms, saves):
+    """
+    Prepara los ficheros en disco y procesa el lote en segundo plano.
+    roms es una lista de (nombre, tamaño, fichero) y saves de (nombre, fichero).
+    """
+    job_id = uuid.uuid4().hex
+    rom_paths = stage_files(job_id, [file for _, _, file in roms])
+    save_paths = stage_files(job_id + "-saves", [file for _, file in saves])
+
+    job = IngestJob(
+        id=job_id, user_id=user_id, status="pending", total=len(roms), processed=0
+    )
+    db.session.add(job)
+    db.session.commit()
+
+    staged_roms = [
+        {"name": name, "size": size, "path": path}
+        for (name, size, _), path in zip(roms, rom_paths)
+    ]
+    staged_saves = [(name, path) for (name, _), path in zip(saves, save_paths)]
+    _job_executor.submit(
+        _run_ingest_job, app, job_id, user_id, staged_roms, staged_saves
+    )
+    return job
+
+
+def _run_ingest_job(app, job_id, user_id, roms, saves):
+    opened = []
+    with app.app_context():
+        try:
+            update_job(job_id, status="running")
+
+            for rom in roms:
+                rom["file"] = open(rom["path"], "rb")
+                opened.append(rom["file"])
+            save_files = []
+            for save_name, save_path in saves:
+                save_file = open(save_path, "rb")
+                opened.append(save_file)
+                save_files.append((save_name, save_file))
+
+            rom_ids, new_roms = ingest_roms(
+                user_id, roms, lambda processed: update_job(job_id, processed=processed)
+            )
+            if save_files:
+                ingest_saves(user_id, rom_ids, save_files)
+            new_hashes = [rom.hash for rom in new_roms]
+            db.session.commit()
+
+            for rom_hash in new_hashes:
+                schedule_blob_compression(rom_hash)
+            update_job(
+                job_id,
+                status="done",
+                processed=len(roms),
+                finished_date=datetime.now(),
+            )
+        except QuotaExceededError:
+            db.session.rollback()
+            update_job(job_id, status="quota", finished_date=datetime.now())
+        except Exception:
+            traceback.print_exc()
+            db.session.rollback()
+            update_job(job_id, status="error", finished_date=datetime.now())
+        finally:
+            for file in opened:
+                file.close()
+            for staging_id in (job_id, job_id + "-saves"):
+                shutil.rmtree(
+                    os.path.join(Config.STAGING_FOLDER, staging_id), ignore_errors=True
+                )
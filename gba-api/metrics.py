@@ -0,0 +1,172 @@
+import os
+import time
+import uuid
+import random
+import traceback
+from datetime import datetime
+
+from flask import g, has_request_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import Config
+
+try:
+    from pyinstrument import Profiler
+except ImportError:
+    Profiler = None
+
+REQUEST_LATENCY = Histogram(
+    "gba_request_duration_seconds",
+    "Tiempo hasta devolver la respuesta, sin contar el envío del cuerpo",
+    ["endpoint", "method", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+SQL_QUERIES = Histogram(
+    "gba_request_sql_queries",
+    "Consultas SQL por petición",
+    ["endpoint"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 250),
+)
+SQL_TIME = Histogram(
+    "gba_request_sql_seconds",
+    "Tiempo en consultas SQL por petición",
+    ["endpoint"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+RESPONSE_BYTES = Counter(
+    "gba_response_bytes_total",
+    "Bytes de cuerpo enviados por la API (sin X-Accel-Redirect)",
+    ["endpoint"],
+)
+HASH_BYTES = Counter("gba_hash_bytes_total", "Bytes procesados al hashear", ["source"])
+HASH_SECONDS = Counter(
+    "gba_hash_seconds_total", "Tiempo dedicado a hashear", ["source"]
+)
+CACHE_STATS = Gauge(
+    "gba_cache",
+    "Estado de las cachés en memoria de los workers",
+    ["cache", "stat"],
+    multiprocess_mode="livesum",
+)
+
+# Cachés cuyo stats() se publica en gba_cache. Los valores se refrescan como
+# mucho una vez por segundo para no tomar sus locks en cada petición
+_caches = {}
+_caches_updated = 0.0
+CACHE_REFRESH_SECONDS = 1.0
+
+
+def register_cache(name, cache):
+    _caches[name] = cache
+
+
+def observe_hash(source, size, seconds):
+    HASH_BYTES.labels(source).inc(size)
+    HASH_SECONDS.labels(source).inc(seconds)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _finish_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    # Las consultas de los trabajos en segundo plano no cuentan para ninguna petición
+    if has_request_context():
+        g.sql_queries = g.get("sql_queries", 0) + 1
+        g.sql_time = g.get("sql_time", 0.0) + elapsed
+
+
+def _update_cache_stats(force=False):
+    global _caches_updated
+    now = time.monotonic()
+    if not force and now - _caches_updated < CACHE_REFRESH_SECONDS:
+        return
+    _caches_updated = now
+    for name, cache in _caches.items():
+        for stat, value in cache.stats().items():
+            CACHE_STATS.labels(name, stat).set(value)
+
+
+def _start_request():
+    g.request_start = time.perf_counter()
+    if Config.PROFILE_SAMPLE_RATE and random.random() < Config.PROFILE_SAMPLE_RATE:
+        g.profiler = Profiler()
+        g.profiler.start()
+
+
+def _finish_request(response):
+    start = g.get("request_start")
+    if start is None:
+        return response
+
+    elapsed = time.perf_counter() - start
+    endpoint = request.endpoint or "none"
+    REQUEST_LATENCY.labels(endpoint, request.method, response.status_code).observe(
+        elapsed
+    )
+    SQL_QUERIES.labels(endpoint).observe(g.get("sql_queries", 0))
+    SQL_TIME.labels(endpoint).observe(g.get("sql_time", 0.0))
+    if (
+        request.method != "HEAD"
+        and response.content_length
+        and "X-Accel-Redirect" not in response.headers
+    ):
+        RESPONSE_BYTES.labels(endpoint).inc(response.content_length)
+    _update_cache_stats()
+
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        save_profile(profiler, endpoint, elapsed)
+    return response
+
+
+def save_profile(profiler, endpoint, elapsed):
+    try:
+        profiler.stop()
+        os.makedirs(Config.PROFILE_FOLDER, exist_ok=True)
+        name = (
+            f"{datetime.now():%Y%m%d-%H%M%S}-{endpoint}-"
+            f"{int(elapsed * 1000)}ms-{uuid.uuid4().hex[:8]}.txt"
+        )
+        with open(os.path.join(Config.PROFILE_FOLDER, name), "w") as f:
+            f.write(profiler.output_text(unicode=True))
+    except Exception:
+        traceback.print_exc()
+
+
+def init_metrics(app):
+    """
+    Mide cada petición. Con PROFILE_SAMPLE_RATE > 0 se perfila esa fracción de
+    peticiones con pyinstrument y el informe queda en PROFILE_FOLDER.
+    """
+    if Config.PROFILE_SAMPLE_RATE and Profiler is None:
+        raise RuntimeError("PROFILE_SAMPLE_RATE necesita el paquete pyinstrument")
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+
+def render_metrics():
+    """
+    Devuelve las métricas en formato de Prometheus. Con varios workers
+    (PROMETHEUS_MULTIPROC_DIR) se suman las de todos los procesos.
+    """
+    _update_cache_stats(force=True)
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
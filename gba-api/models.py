@@ -1,7 +1,9 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 
-db = SQLAlchemy()
+from database import RoutingSession
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 
 class User(db.Model):
@@ -9,6 +11,9 @@ class User(db.Model):
     username = db.Column(db.String(80), unique=True, nullable=False)
     password = db.Column(db.String(200), nullable=False)
     register_date = db.Column(db.DateTime, default=datetime.now)
+    # Bytes de ROMs y partidas del usuario, mantenido en cada alta y baja para
+    # comprobar la cuota sin sumar sus ficheros. NULL si aún no se ha calculado
+    storage_used = db.Column(db.BigInteger, default=0)
     profile = db.relationship(
         "Profile", uselist=False, back_populates="user", cascade="all, delete-orphan"
     )
@@ -25,17 +30,46 @@ class Profile(db.Model):
     user = db.relationship("User", back_populates="profile")
 
 
+class RomBlob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    hash = db.Column(db.String(64), unique=True, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    path = db.Column(db.String(512), nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    platform = db.Column(db.String(8))
+    title = db.Column(db.String(16), index=True)
+    game_code = db.Column(db.String(4), index=True)
+    maker_code = db.Column(db.String(2))
+    version = db.Column(db.Integer)
+    header_checksum = db.Column(db.Integer)
+    header_checksum_valid = db.Column(db.Boolean)
+    save_type = db.Column(db.String(16))
+    crc32 = db.Column(db.BigInteger)
+    created_date = db.Column(db.DateTime, default=datetime.now)
+    roms = db.relationship("Rom", back_populates="blob")
+
+
 class Rom(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(256), nullable=False)
-    hash = db.Column(db.String(64), nullable=False, index=True)
+    hash = db.Column(
+        db.String(64), db.ForeignKey("rom_blob.hash"), nullable=False, index=True
+    )
     size = db.Column(db.Integer, nullable=False)
     path = db.Column(db.String(512), nullable=False)
     upload_date = db.Column(db.DateTime, default=datetime.now)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), index=True)
     user = db.relationship("User", back_populates="roms")
+    blob = db.relationship("RomBlob", back_populates="roms")
     saves = db.relationship("Save", back_populates="rom")
 
+    # Índices compuestos para la paginación por cursor de /api/loadroms
+    __table_args__ = (
+        db.Index("ix_rom_user_upload_date", "user_id", "upload_date", "id"),
+        db.Index("ix_rom_user_name", "user_id", "name", "id"),
+        db.Index("ix_rom_user_size", "user_id", "size", "id"),
+    )
+
 
 class Save(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -43,7 +77,60 @@ class Save(db.Model):
     size = db.Column(db.Integer, nullable=False)
     path = db.Column(db.String(512), nullable=False)
     upload_date = db.Column(db.DateTime, default=datetime.now)
+    kind = db.Column(
+        db.String(8), nullable=False, default="save", server_default="save"
+    )
+    stored_size = db.Column(db.Integer)
+    hash = db.Column(db.String(64), index=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), index=True)
     rom_id = db.Column(db.Integer, db.ForeignKey("rom.id"), index=True)
+    base_id = db.Column(db.Integer, db.ForeignKey("save.id"), index=True)
     user = db.relationship("User", back_populates="saves")
     rom = db.relationship("Rom", back_populates="saves")
+    base = db.relationship("Save", remote_side=[id])
+
+
+class UploadSession(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(8), nullable=False)
+    name = db.Column(db.String(256), nullable=False)
+    hash = db.Column(db.String(64), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    received = db.Column(db.Integer, nullable=False, default=0)
+    created_date = db.Column(db.DateTime, default=datetime.now)
+    expires_date = db.Column(db.DateTime, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), index=True)
+    rom_id = db.Column(db.Integer, db.ForeignKey("rom.id"))
+
+
+class IngestJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    status = db.Column(db.String(16), nullable=False, default="pending")
+    total = db.Column(db.Integer, nullable=False, default=0)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    created_date = db.Column(db.DateTime, default=datetime.now)
+    finished_date = db.Column(db.DateTime)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), index=True)
+
+
+class Conversation(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    created_date = db.Column(db.DateTime, default=datetime.now)
+    updated_date = db.Column(db.DateTime, default=datetime.now, index=True)
+    messages = db.relationship(
+        "ConversationMessage",
+        back_populates="conversation",
+        cascade="all, delete-orphan",
+        order_by="ConversationMessage.id",
+    )
+
+
+class ConversationMessage(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(
+        db.String(32), db.ForeignKey("conversation.id"), nullable=False, index=True
+    )
+    role = db.Column(db.String(8), nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    created_date = db.Column(db.DateTime, default=datetime.now)
+    conversation = db.relationship("Conversation", back_populates="messages")
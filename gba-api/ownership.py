@@ -0,0 +1,75 @@
+import hmac
+import hashlib
+import secrets
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+from config import Config
+from storage import blob_storage
+from utils import blob_relative_path
+
+# Los retos van firmados y caducan, así el servidor no tiene que guardarlos
+_serializer = URLSafeTimedSerializer(Config.JWT_SECRET_KEY, salt="rom-challenge")
+
+
+def _random_ranges(size):
+    length = min(Config.ROM_CHALLENGE_RANGE_SIZE, size)
+    ranges = []
+    for _ in range(Config.ROM_CHALLENGE_RANGES):
+        start = secrets.randbelow(size - length + 1)
+        ranges.append([start, start + length])
+    return ranges
+
+
+def issue_challenge(user_id, rom_hash, size):
+    """
+    Crea el reto que demuestra que el cliente tiene la ROM: debe devolver el
+    HMAC-SHA256 con el nonce como clave de los bytes de cada rango, concatenados.
+    Se emite aunque el blob no exista para no desvelar qué ROMs hay en el servidor.
+    """
+    nonce = secrets.token_hex(16)
+    ranges = _random_ranges(size)
+    token = _serializer.dumps(
+        {
+            "uid": user_id,
+            "hash": rom_hash,
+            "size": size,
+            "nonce": nonce,
+            "ranges": ranges,
+        }
+    )
+    return {"token": token, "nonce": nonce, "ranges": ranges}
+
+
+def verify_proof(user_id, entry, blob):
+    """
+    Comprueba la prueba de posesión de una entrada de /api/attachroms contra el
+    contenido del blob. Cualquier reto inválido, caducado o ajeno se rechaza.
+    """
+    token = entry.get("token")
+    proof = entry.get("proof")
+    if not isinstance(token, str) or not isinstance(proof, str):
+        return False
+
+    try:
+        challenge = _serializer.loads(token, max_age=Config.ROM_CHALLENGE_TTL)
+    except BadSignature:
+        return False
+
+    if (
+        challenge["uid"] != user_id
+        or challenge["hash"] != blob.hash
+        or challenge["size"] != blob.size
+    ):
+        return False
+
+    mac = hmac.new(bytes.fromhex(challenge["nonce"]), digestmod=hashlib.sha256)
+    blob_key = blob_relative_path(blob.hash)
+    try:
+        for start, end in challenge["ranges"]:
+            for chunk in blob_storage.read_range(blob_key, start, end):
+                mac.update(chunk)
+    except OSError:
+        return False
+
+    return hmac.compare_digest(mac.hexdigest(), proof.lower())
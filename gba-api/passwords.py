@@ -0,0 +1,90 @@
+import secrets
+from functools import cache
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from config import Config
+from runtime import native_executor
+
+try:
+    from argon2 import PasswordHasher, Type
+    from argon2.exceptions import InvalidHashError, VerificationError
+except ImportError:
+    PasswordHasher = None
+
+# Cada hash ocupa un núcleo y, con argon2, ARGON2_MEMORY_COST KiB. El pool los
+# calcula fuera de la petición y limita cuántos se hacen a la vez por worker
+_executor = native_executor(Config.PASSWORD_HASH_WORKERS, "password")
+
+
+def create_hasher():
+    if Config.PASSWORD_SCHEME != "argon2":
+        return None
+    if PasswordHasher is None:
+        raise RuntimeError("PASSWORD_SCHEME=argon2 necesita el paquete argon2-cffi")
+    return PasswordHasher(
+        time_cost=Config.ARGON2_TIME_COST,
+        memory_cost=Config.ARGON2_MEMORY_COST,
+        parallelism=Config.ARGON2_PARALLELISM,
+        type=Type.ID,
+    )
+
+
+hasher = create_hasher()
+
+
+def _hash(password):
+    if hasher is not None:
+        return hasher.hash(password)
+    return generate_password_hash(password, method=Config.PASSWORD_WERKZEUG_METHOD)
+
+
+@cache
+def _werkzeug_prefix():
+    # Werkzeug completa los parámetros por defecto ("scrypt" pasa a ser
+    # "scrypt:32768:8:1"), así que se compara con un hash real
+    return _hash("").split("$", 1)[0]
+
+
+@cache
+def _dummy_hash():
+    return _hash(secrets.token_hex(16))
+
+
+def _needs_rehash(stored):
+    if stored.startswith("$argon2"):
+        return hasher is None or hasher.check_needs_rehash(stored)
+    return hasher is not None or stored.split("$", 1)[0] != _werkzeug_prefix()
+
+
+def _verify(stored, password):
+    # Sin usuario se compara igualmente con un hash para que la respuesta
+    # tarde lo mismo y no delate qué usuarios existen
+    if stored is None:
+        _verify(_dummy_hash(), password)
+        return False, None
+
+    if stored.startswith("$argon2"):
+        if PasswordHasher is None:
+            raise RuntimeError("Hay contraseñas en argon2 y falta argon2-cffi")
+        try:
+            (hasher or PasswordHasher()).verify(stored, password)
+        except (VerificationError, InvalidHashError):
+            return False, None
+    elif not check_password_hash(stored, password):
+        return False, None
+
+    return True, _hash(password) if _needs_rehash(stored) else None
+
+
+def hash_password(password):
+    return _executor.submit(_hash, password).result()
+
+
+def verify_password(stored, password):
+    """
+    Comprueba la contraseña contra el hash guardado (None si el usuario no
+    existe). Devuelve (válida, nuevo hash), con el nuevo hash solo cuando el
+    guardado usa otro esquema u otros parámetros que los configurados.
+    """
+    return _executor.submit(_verify, stored, password).result()
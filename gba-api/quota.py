@@ -0,0 +1,104 @@
+from sqlalchemy import case, func, update
+
+from config import Config
+from models import db, User, Rom, Save
+
+
+class QuotaExceededError(Exception):
+    """
+    La operación no cabe en la cuota de almacenamiento del usuario.
+    """
+
+    def __init__(self, used, quota):
+        super().__init__("Se ha superado la cuota de almacenamiento")
+        self.used = used
+        self.quota = quota
+
+
+def calculate_storage(user_id):
+    """
+    Suma lo que ocupan las ROMs y partidas del usuario. Las partidas cuentan
+    lo que ocupan guardadas (el delta, si lo es).
+    """
+    roms = (
+        db.session.query(func.coalesce(func.sum(Rom.size), 0))
+        .filter(Rom.user_id == user_id)
+        .scalar()
+    )
+    saves = (
+        db.session.query(
+            func.coalesce(func.sum(func.coalesce(Save.stored_size, Save.size)), 0)
+        )
+        .filter(Save.user_id == user_id)
+        .scalar()
+    )
+    return roms + saves
+
+
+def storage_used(user_id):
+    """
+    Devuelve el contador del usuario. Los usuarios anteriores al contador lo
+    tienen a NULL y se calcula una sola vez.
+    """
+    used = db.session.query(User.storage_used).filter(User.id == user_id).scalar()
+    if used is None:
+        used = calculate_storage(user_id)
+        db.session.execute(
+            update(User)
+            .where(User.id == user_id, User.storage_used.is_(None))
+            .values(storage_used=used)
+        )
+    return used
+
+
+def check_storage(user_id, size):
+    """
+    Comprobación previa, sin reservar, para rechazar una subida antes de
+    recibir o preparar los ficheros.
+    """
+    quota = Config.STORAGE_QUOTA
+    if quota:
+        used = storage_used(user_id)
+        if used + size > quota:
+            raise QuotaExceededError(used, quota)
+
+
+def storage_remaining(user_id):
+    if not Config.STORAGE_QUOTA:
+        return None
+    return max(0, Config.STORAGE_QUOTA - storage_used(user_id))
+
+
+def reserve_storage(user_id, size):
+    """
+    Suma size al contador si cabe en la cuota. Es un único UPDATE condicional,
+    así que dos peticiones a la vez no pueden pasarse entre las dos, y se
+    deshace junto con la transacción si algo falla después.
+    """
+    if size <= 0:
+        return
+    storage_used(user_id)
+
+    statement = (
+        update(User)
+        .where(User.id == user_id)
+        .values(storage_used=User.storage_used + size)
+    )
+    if Config.STORAGE_QUOTA:
+        statement = statement.where(User.storage_used + size <= Config.STORAGE_QUOTA)
+    if db.session.execute(statement).rowcount == 0:
+        raise QuotaExceededError(storage_used(user_id), Config.STORAGE_QUOTA)
+
+
+def release_storage(user_id, size):
+    if size <= 0:
+        return
+    db.session.execute(
+        update(User)
+        .where(User.id == user_id, User.storage_used.isnot(None))
+        .values(
+            storage_used=case(
+                (User.storage_used > size, User.storage_used - size), else_=0
+            )
+        )
+    )
@@ -0,0 +1,160 @@
+import math
+import time
+import traceback
+from functools import wraps
+from threading import Lock
+
+from flask import current_app, jsonify, request
+from flask_jwt_extended import decode_token
+
+from config import Config
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class MemoryBackend:
+    """
+    Cubos en memoria del proceso. Cada worker de gunicorn tiene los suyos, así
+    que el límite real es el configurado por el número de workers.
+    """
+
+    MAX_BUCKETS = 10000
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = Lock()
+
+    def take(self, key, capacity, rate, now):
+        with self._lock:
+            tokens, last, _ = self._buckets.get(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - last) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            # Momento en el que el cubo vuelve a estar lleno y se puede olvidar
+            full_date = now + (capacity - tokens) / rate
+            self._buckets[key] = (tokens, now, full_date)
+            if len(self._buckets) > self.MAX_BUCKETS:
+                self._prune(now)
+            return allowed, tokens
+
+    def _prune(self, now):
+        for key in [key for key, value in self._buckets.items() if value[2] <= now]:
+            del self._buckets[key]
+
+
+# Recarga y consumo en un solo paso en el servidor, sin carreras entre workers
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+local tokens = tonumber(state[1]) or capacity
+local last = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - last) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'time', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+class RedisBackend:
+    """
+    Cubos compartidos en Redis o en cualquier servidor compatible con su
+    protocolo (Valkey, KeyDB...).
+    """
+
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url)
+        self._script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def take(self, key, capacity, rate, now):
+        allowed, tokens = self._script(
+            keys=[f"ratelimit:{key}"], args=[capacity, rate, now]
+        )
+        return bool(allowed), float(tokens)
+
+
+def create_backend():
+    if Config.RATE_LIMIT_BACKEND == "none":
+        return None
+    if Config.RATE_LIMIT_BACKEND == "redis":
+        if redis is None:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis necesita el paquete redis")
+        return RedisBackend(Config.REDIS_URL)
+    return MemoryBackend()
+
+
+backend = create_backend()
+
+
+def set_backend(new_backend):
+    """
+    Sustituye el almacén de los cubos por cualquier objeto con
+    take(key, capacity, rate, now).
+    """
+    global backend
+    backend = new_backend
+
+
+def client_key():
+    # Usuario de la sesión si la hay; si no, la IP. El token se decodifica sin
+    # la comprobación CSRF de la petición, que la propia ruta hace después
+    user = None
+    token = request.cookies.get(current_app.config["JWT_ACCESS_COOKIE_NAME"])
+    if token:
+        try:
+            claims = decode_token(token)
+            user = claims.get("uid") or claims.get(
+                current_app.config["JWT_IDENTITY_CLAIM"]
+            )
+        except Exception:
+            user = None
+    if user is not None:
+        return f"user:{user}"
+    return f"ip:{request.remote_addr}"
+
+
+def rate_limit(bucket):
+    """
+    Limita la ruta con el cubo indicado de RATE_LIMITS. Al agotarse responde
+    429 con Retry-After. Si el almacén de los cubos falla se deja pasar la
+    petición.
+    """
+    capacity, period = Config.RATE_LIMITS[bucket]
+    rate = capacity / period
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if backend is None:
+                return view(*args, **kwargs)
+
+            try:
+                allowed, tokens = backend.take(
+                    f"{bucket}:{client_key()}", capacity, rate, time.time()
+                )
+            except Exception:
+                traceback.print_exc()
+                return view(*args, **kwargs)
+
+            if not allowed:
+                retry_after = math.ceil((1 - tokens) / rate)
+                return (
+                    jsonify({"error": "Demasiadas peticiones, inténtalo más tarde"}),
+                    429,
+                    {"Retry-After": str(max(retry_after, 1))},
+                )
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
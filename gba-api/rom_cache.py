@@ -0,0 +1,83 @@
+import mmap
+from collections import OrderedDict
+from threading import Lock
+
+from config import Config
+
+
+def map_file(file_path):
+    """
+    Proyecta el fichero en memoria de solo lectura. Los workers de gunicorn
+    que proyectan el mismo fichero comparten las páginas de la caché del
+    sistema, así que la ROM solo se lee de disco una vez.
+    """
+    with open(file_path, "rb") as f:
+        if f.seek(0, 2) == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class RomCache:
+    """
+    Caché LRU limitada por bytes del contenido de las ROMs más jugadas. Los
+    blobs no cambian nunca, así que solo hace falta invalidar al borrarlos.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, loader):
+        """
+        Devuelve (contenido, acierto). Si no está en caché se carga con loader.
+        """
+        with self._lock:
+            buffer = self._entries.get(key)
+            if buffer is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return buffer, True
+            self.misses += 1
+
+        buffer = loader()
+        if len(buffer) > self.max_bytes:
+            return buffer, False
+
+        with self._lock:
+            # Otro hilo puede haberla cargado a la vez
+            if key in self._entries:
+                return self._entries[key], False
+            self._entries[key] = buffer
+            self.size += len(buffer)
+            while self.size > self.max_bytes:
+                # No se cierra el mmap: puede haber descargas usándolo y se
+                # libera solo cuando desaparece la última referencia
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+        return buffer, False
+
+    def discard(self, key):
+        with self._lock:
+            buffer = self._entries.pop(key, None)
+            if buffer is not None:
+                self.size -= len(buffer)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+rom_cache = RomCache(Config.ROM_CACHE_BYTES)
@@ -0,0 +1,162 @@
+import re
+import time
+import zlib
+import hashlib
+
+from metrics import observe_hash
+
+# Cabecera de cartucho de GBA: salto al punto de entrada, título, código de
+# juego, fabricante, valor fijo, versión y checksum de complemento de 0xA0 a 0xBC
+GBA_ENTRY_BRANCH = 0x03
+GBA_TITLE = slice(0xA0, 0xAC)
+GBA_GAME_CODE = slice(0xAC, 0xB0)
+GBA_MAKER_CODE = slice(0xB0, 0xB2)
+GBA_FIXED_VALUE = 0xB2
+GBA_VERSION = 0xBC
+GBA_CHECKSUM = 0xBD
+
+# Cabecera de cartucho de GB/GBC, de 0x134 a 0x14F
+GB_TITLE = slice(0x134, 0x144)
+GBC_TITLE = slice(0x134, 0x13F)
+GBC_MANUFACTURER = slice(0x13F, 0x143)
+GB_CGB_FLAG = 0x143
+GB_NEW_LICENSEE = slice(0x144, 0x146)
+GB_CARTRIDGE_TYPE = 0x147
+GB_OLD_LICENSEE = 0x14B
+GB_VERSION = 0x14C
+GB_CHECKSUM = 0x14D
+
+HEADER_SIZE = 0x150
+
+# Tipos de cartucho de GB con batería, es decir, con partida guardada
+GB_BATTERY_TYPES = {0x03, 0x06, 0x09, 0x0D, 0x0F, 0x10, 0x13, 0x1B, 0x1E, 0x22, 0xFF}
+
+# Las librerías de Nintendo dejan una cadena con el tipo de memoria en la ROM
+SAVE_MARKER = re.compile(rb"(EEPROM|SRAM_F|SRAM|FLASH1M|FLASH512|FLASH)_V\d{3}")
+SAVE_TYPES = {
+    b"EEPROM": "eeprom",
+    b"SRAM_F": "sram",
+    b"SRAM": "sram",
+    b"FLASH1M": "flash1m",
+    b"FLASH512": "flash512",
+    b"FLASH": "flash512",
+}
+MARKER_OVERLAP = 16
+
+
+def _text(data):
+    return "".join(chr(byte) for byte in data if 0x20 <= byte < 0x7F).strip()
+
+
+def parse_gba_header(header):
+    # La primera instrucción es un salto ARM (B, condición siempre) al código
+    if (
+        len(header) < GBA_CHECKSUM + 1
+        or header[GBA_FIXED_VALUE] != 0x96
+        or header[GBA_ENTRY_BRANCH] != 0xEA
+    ):
+        return None
+
+    # Muchos hacks y homebrew no corrigen el checksum y los emuladores no lo
+    # comprueban, así que solo se anota si es correcto
+    checksum = header[GBA_CHECKSUM]
+    return {
+        "platform": "gba",
+        "title": _text(header[GBA_TITLE]),
+        "game_code": _text(header[GBA_GAME_CODE]),
+        "maker_code": _text(header[GBA_MAKER_CODE]),
+        "version": header[GBA_VERSION],
+        "header_checksum": checksum,
+        "header_checksum_valid": checksum == (-sum(header[0xA0:0xBD]) - 0x19) & 0xFF,
+        "save_type": None,
+    }
+
+
+def parse_gb_header(header):
+    if len(header) < HEADER_SIZE:
+        return None
+
+    checksum = 0
+    for byte in header[0x134:0x14D]:
+        checksum = (checksum - byte - 1) & 0xFF
+    if checksum != header[GB_CHECKSUM]:
+        return None
+
+    is_color = header[GB_CGB_FLAG] in (0x80, 0xC0)
+    if header[GB_OLD_LICENSEE] == 0x33:
+        maker_code = _text(header[GB_NEW_LICENSEE])
+    else:
+        maker_code = f"{header[GB_OLD_LICENSEE]:02X}"
+
+    return {
+        "platform": "gbc" if is_color else "gb",
+        "title": _text(header[GBC_TITLE] if is_color else header[GB_TITLE]),
+        "game_code": _text(header[GBC_MANUFACTURER]) if is_color else "",
+        "maker_code": maker_code,
+        "version": header[GB_VERSION],
+        "header_checksum": checksum,
+        "header_checksum_valid": True,
+        "save_type": (
+            "sram" if header[GB_CARTRIDGE_TYPE] in GB_BATTERY_TYPES else "none"
+        ),
+    }
+
+
+def parse_rom_header(header, filename):
+    """
+    Devuelve los metadatos de la cabecera o None si no es una ROM válida.
+    """
+    if filename.rsplit(".", 1)[-1].lower() == "gba":
+        return parse_gba_header(header)
+    return parse_gb_header(header)
+
+
+def read_rom_metadata(file, filename):
+    file.seek(0)
+    header = file.read(HEADER_SIZE)
+    file.seek(0)
+    return parse_rom_header(header, filename)
+
+
+class RomScanner:
+    """
+    Calcula el SHA-256 y el CRC-32 y busca la cadena del tipo de guardado a
+    medida que llegan los datos, sin volver a leer el fichero.
+    """
+
+    def __init__(self):
+        self._hash = hashlib.sha256()
+        self._tail = b""
+        self.crc32 = 0
+        self.save_type = None
+        # Para la métrica de velocidad de hash
+        self.size = 0
+        self.seconds = 0.0
+
+    def update(self, chunk):
+        start = time.perf_counter()
+        self._hash.update(chunk)
+        self.crc32 = zlib.crc32(chunk, self.crc32)
+        if self.save_type is None:
+            match = SAVE_MARKER.search(self._tail + chunk)
+            if match:
+                self.save_type = SAVE_TYPES[match.group(1)]
+            self._tail = chunk[-MARKER_OVERLAP:]
+        self.size += len(chunk)
+        self.seconds += time.perf_counter() - start
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+def scan_rom(file, chunk_size=65536):
+    scanner = RomScanner()
+    file.seek(0)
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        scanner.update(chunk)
+    file.seek(0)
+    observe_hash("rom", scanner.size, scanner.seconds)
+    return scanner
@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from gevent import get_hub, monkey, spawn
+    from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+except ImportError:
+    monkey = None
+
+
+def gevent_patched():
+    """
+    Indica si el proceso corre en un worker de gevent, que parchea threading
+    y los sockets al arrancar.
+    """
+    return monkey is not None and monkey.is_module_patched("threading")
+
+
+def native_executor(max_workers, thread_name_prefix):
+    """
+    Pool de hilos del sistema para el trabajo de CPU (hashes, compresión).
+    Con gevent un ThreadPoolExecutor normal usaría corutinas y dejaría al resto
+    de conexiones del worker esperando mientras calcula.
+    """
+    if gevent_patched():
+        return NativeThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=thread_name_prefix
+        )
+    return ThreadPoolExecutor(
+        max_workers=max_workers, thread_name_prefix=thread_name_prefix
+    )
+
+
+def run_blocking(function, *args):
+    """
+    Ejecuta una llamada que bloquea (lectura de disco, un hash largo) en un
+    hilo del sistema cuando el worker es de gevent. En los demás modos se
+    llama directamente.
+    """
+    if gevent_patched():
+        return get_hub().threadpool.apply(function, args)
+    return function(*args)
+
+
+def run_in_background(executor, function, *args):
+    """
+    Encola una tarea sin esperar su resultado. El pool de gevent bloquea submit
+    mientras todos sus hilos están ocupados, así que se encola desde otra
+    corutina para no retener la petición.
+    """
+    if gevent_patched():
+        spawn(executor.submit, function, *args)
+    else:
+        executor.submit(function, *args)
@@ -0,0 +1,109 @@
+import os
+import struct
+import hashlib
+
+from config import Config
+from models import Save
+from utils import unique_save_name
+from storage import user_storage
+from quota import reserve_storage
+
+# Cabecera del delta: firma, versión del formato y tamaño final de la partida
+DELTA_MAGIC = b"GBSD"
+DELTA_HEADER = struct.Struct(">4sBI")
+DELTA_RUN = struct.Struct(">II")
+
+
+def encode_delta(base_data, new_data, block_size=256):
+    """
+    Codifica new_data como los tramos de bloques que cambian respecto a base_data.
+    """
+    runs = []
+    run_start = None
+    for offset in range(0, len(new_data), block_size):
+        changed = (
+            new_data[offset : offset + block_size]
+            != base_data[offset : offset + block_size]
+        )
+        if changed and run_start is None:
+            run_start = offset
+        elif not changed and run_start is not None:
+            runs.append((run_start, offset))
+            run_start = None
+    if run_start is not None:
+        runs.append((run_start, len(new_data)))
+
+    parts = [DELTA_HEADER.pack(DELTA_MAGIC, 1, len(new_data))]
+    for start, end in runs:
+        parts.append(DELTA_RUN.pack(start, end - start))
+        parts.append(new_data[start:end])
+    return b"".join(parts)
+
+
+def apply_delta(base_data, delta):
+    magic, version, target_size = DELTA_HEADER.unpack_from(delta)
+    if magic != DELTA_MAGIC or version != 1:
+        raise ValueError("Formato de delta desconocido")
+
+    data = bytearray(base_data[:target_size].ljust(target_size, b"\0"))
+    position = DELTA_HEADER.size
+    while position < len(delta):
+        start, length = DELTA_RUN.unpack_from(delta, position)
+        position += DELTA_RUN.size
+        data[start : start + length] = delta[position : position + length]
+        position += length
+    return bytes(data)
+
+
+def read_save_file(save):
+    return user_storage.read(save.path)
+
+
+def load_save_data(save):
+    if save.base_id is None:
+        return read_save_file(save)
+    return apply_delta(read_save_file(save.base), read_save_file(save))
+
+
+def store_save_version(user_id, rom_id, save_name, data, kind="save"):
+    """
+    Guarda una nueva versión de la partida de una ROM. Se almacena como delta
+    sobre la última instantánea completa salvo que el delta ya no compense,
+    en cuyo caso se crea una instantánea nueva que pasa a ser la base.
+    """
+    save_hash = hashlib.sha256(data).hexdigest()
+    stored_save_name = unique_save_name(save_name)
+    base = (
+        Save.query.filter_by(user_id=user_id, rom_id=rom_id, kind=kind, base_id=None)
+        .order_by(Save.upload_date.desc(), Save.id.desc())
+        .first()
+    )
+
+    content = data
+    base_id = None
+    if base:
+        delta = encode_delta(read_save_file(base), data, Config.SAVE_DELTA_BLOCK_SIZE)
+        delta_count = Save.query.filter_by(base_id=base.id).count()
+        if (
+            len(delta) <= len(data) * Config.SAVE_REBASE_RATIO
+            and delta_count < Config.SAVE_MAX_DELTAS
+        ):
+            content = delta
+            base_id = base.id
+            stored_save_name += ".delta"
+
+    save_path = os.path.join(str(user_id), "saves", stored_save_name)
+    reserve_storage(user_id, len(content))
+    user_storage.write(save_path, content)
+
+    return Save(
+        name=save_name,
+        kind=kind,
+        size=len(data),
+        stored_size=len(content),
+        hash=save_hash,
+        path=save_path,
+        user_id=user_id,
+        rom_id=rom_id,
+        base_id=base_id,
+    )
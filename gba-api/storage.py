@@ -0,0 +1,197 @@
+import os
+import uuid
+
+from config import Config
+from runtime import run_blocking
+
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+
+class LocalStorage:
+    """
+    Ficheros en un directorio del propio servidor. Las claves son rutas
+    relativas a la raíz.
+    """
+
+    is_local = True
+
+    def __init__(self, root):
+        self.root = root
+
+    def local_path(self, key):
+        return os.path.join(self.root, key)
+
+    def exists(self, key):
+        return os.path.isfile(self.local_path(key))
+
+    def size(self, key):
+        return os.path.getsize(self.local_path(key))
+
+    def read(self, key):
+        with open(self.local_path(key), "rb") as f:
+            return f.read()
+
+    def read_range(self, key, start, end, chunk_size=65536):
+        with open(self.local_path(key), "rb") as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = run_blocking(f.read, min(chunk_size, remaining))
+                if not chunk:
+                    raise IOError(f"El fichero {key} ha cambiado")
+                remaining -= len(chunk)
+                yield chunk
+
+    def write(self, key, data):
+        file_path = self.local_path(key)
+        temp_path = f"{file_path}.{uuid.uuid4().hex}.part"
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, file_path)
+
+    def upload(self, key, file, chunk_size=65536):
+        file_path = self.local_path(key)
+        temp_path = f"{file_path}.{uuid.uuid4().hex}.part"
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        file.seek(0)
+        with open(temp_path, "wb") as f:
+            while True:
+                chunk = file.read(chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+        file.seek(0)
+        os.replace(temp_path, file_path)
+
+    def move(self, key, source_path):
+        file_path = self.local_path(key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        os.replace(source_path, file_path)
+
+    def copy(self, key, source_path):
+        # Un enlace duro en lugar de copiar los bytes: el área de preparación
+        # está en el mismo volumen que el almacén
+        file_path = self.local_path(key)
+        temp_path = f"{file_path}.{uuid.uuid4().hex}.part"
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        os.link(source_path, temp_path)
+        os.replace(temp_path, file_path)
+
+    def delete(self, key):
+        file_path = self.local_path(key)
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+
+    def presigned_url(self, key, filename, expires):
+        return None
+
+
+class S3Storage:
+    """
+    Ficheros en un bucket compatible con S3 (AWS, MinIO...). Las claves se
+    guardan bajo un prefijo por tipo de dato.
+    """
+
+    is_local = False
+
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=Config.S3_ENDPOINT_URL,
+            region_name=Config.S3_REGION,
+            aws_access_key_id=Config.S3_ACCESS_KEY_ID,
+            aws_secret_access_key=Config.S3_SECRET_ACCESS_KEY,
+            config=BotoConfig(
+                signature_version="s3v4",
+                s3={"addressing_style": Config.S3_ADDRESSING_STYLE},
+                max_pool_connections=Config.S3_MAX_CONNECTIONS,
+            ),
+        )
+
+    def _key(self, key):
+        return self.prefix + key.replace(os.sep, "/")
+
+    def local_path(self, key):
+        return None
+
+    def _head(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def exists(self, key):
+        return self._head(key) is not None
+
+    def size(self, key):
+        return self._head(key)["ContentLength"]
+
+    def read(self, key):
+        response = self.client.get_object(Bucket=self.bucket, Key=self._key(key))
+        return response["Body"].read()
+
+    def read_range(self, key, start, end, chunk_size=65536):
+        if end <= start:
+            return
+        response = self.client.get_object(
+            Bucket=self.bucket, Key=self._key(key), Range=f"bytes={start}-{end - 1}"
+        )
+        body = response["Body"]
+        try:
+            yield from body.iter_chunks(chunk_size)
+        finally:
+            body.close()
+
+    def write(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data)
+
+    def upload(self, key, file, chunk_size=65536):
+        # Las ROMs caben en un solo PUT; botocore lee el fichero por trozos y,
+        # a diferencia de upload_fileobj, no lo cierra al terminar
+        file.seek(0)
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=file)
+        file.seek(0)
+
+    def move(self, key, source_path):
+        self.copy(key, source_path)
+        os.remove(source_path)
+
+    def copy(self, key, source_path):
+        self.client.upload_file(source_path, self.bucket, self._key(key))
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def presigned_url(self, key, filename, expires):
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={
+                "Bucket": self.bucket,
+                "Key": self._key(key),
+                "ResponseContentDisposition": f"inline; filename={filename}",
+            },
+            ExpiresIn=int(expires.total_seconds()),
+        )
+
+
+def create_storage(local_root, prefix):
+    if Config.STORAGE_BACKEND == "s3":
+        if boto3 is None:
+            raise RuntimeError("STORAGE_BACKEND=s3 necesita el paquete boto3")
+        return S3Storage(Config.S3_BUCKET, prefix)
+    return LocalStorage(local_root)
+
+
+# Blobs de ROMs direccionados por contenido y ficheros de cada usuario (partidas)
+blob_storage = create_storage(Config.BLOB_FOLDER, "blobs/")
+user_storage = create_storage(Config.ROM_FOLDER, "users/")
@@ -1,9 +1,29 @@
 import os
+import json
+import time
+import uuid
+import base64
 import hashlib
+from collections import OrderedDict
+from datetime import datetime
+from urllib.parse import quote
 
-from flask import Response
+from flask import Response, current_app, redirect, request
+from werkzeug.http import http_date, quote_etag
+from werkzeug.wsgi import wrap_file
 
 from config import Config
+from compression import (
+    ENCODINGS,
+    remove_variants,
+    schedule_compression,
+    select_variant,
+    variant_path,
+)
+from rom_cache import map_file, rom_cache
+from storage import blob_storage, user_storage
+from runtime import run_blocking
+from metrics import observe_hash
 
 
 def allowed_file(filename):
@@ -15,6 +35,10 @@ def allowed_file(filename):
 
 
 def create_user_directories(user_id):
+    # En S3 los directorios no existen, basta con el prefijo de la clave
+    if not user_storage.is_local:
+        return
+
     base_dir = Config.ROM_FOLDER
     dirs = [
         os.path.join(base_dir, str(user_id)),
@@ -26,6 +50,22 @@ def create_user_directories(user_id):
         os.makedirs(directory, exist_ok=True)
 
 
+def unique_save_name(filename):
+    base_save_name, save_extension = os.path.splitext(filename)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    unique_id = str(uuid.uuid4())[:8]
+    return f"{base_save_name}_{timestamp}_{unique_id}{save_extension}"
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    padding = "=" * (-len(cursor) % 4)
+    return json.loads(base64.urlsafe_b64decode(cursor + padding))
+
+
 def get_file_size(file):
     current_pos = file.tell()
     file.seek(0, 2)
@@ -34,22 +74,131 @@ def get_file_size(file):
     return size
 
 
-def calculate_hash_and_save_streaming(file, file_path, chunk_size=16384):
+def calculate_file_hash(file, chunk_size=16384):
     hash_sha256 = hashlib.sha256()
     file.seek(0)
+    start = time.perf_counter()
+    size = 0
 
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        hash_sha256.update(chunk)
+        size += len(chunk)
 
-    with open(file_path, "wb") as f:
-        while True:
-            chunk = file.read(chunk_size)
+    observe_hash("file", size, time.perf_counter() - start)
+    file.seek(0)
+    return hash_sha256.hexdigest()
+
+
+def blob_relative_path(file_hash):
+    return os.path.join(file_hash[:2], file_hash)
+
+
+def blob_absolute_path(file_hash):
+    return os.path.join(Config.BLOB_FOLDER, blob_relative_path(file_hash))
+
+
+def store_blob_streaming(file, file_hash, chunk_size=16384):
+    """
+    Guarda el fichero en el almacén global direccionado por contenido. Se
+    escribe siempre, aunque el fichero exista, porque puede ser un blob sin
+    fila que está borrando /api/deleterom; el almacén lo sustituye de una vez.
+    """
+    blob_key = blob_relative_path(file_hash)
+    blob_storage.upload(blob_key, file, chunk_size)
+    return blob_key
+
+
+def remove_blob(file_hash):
+    blob_key = blob_relative_path(file_hash)
+    blob_storage.delete(blob_key)
+    rom_cache.discard(blob_key)
+    if blob_storage.is_local:
+        blob_path = blob_absolute_path(file_hash)
+        rom_cache.discard(blob_path)
+        for encoding in ENCODINGS:
+            rom_cache.discard(variant_path(blob_path, encoding))
+        remove_variants(blob_path)
+
+
+def schedule_blob_compression(file_hash):
+    # Las variantes comprimidas solo se generan con almacenamiento local
+    if blob_storage.is_local:
+        schedule_compression(blob_absolute_path(file_hash))
+
+
+def upload_part_path(upload):
+    # Las partes siempre se escriben en disco local, sea cual sea el almacén
+    return os.path.join(Config.STAGING_FOLDER, "uploads", f"{upload.id}.part")
+
+
+# Estado SHA-256 de las subidas por partes que llegan en orden a este proceso.
+# Si un trozo llega a otro worker el hash se recalcula leyendo el fichero al final.
+_upload_hashers = OrderedDict()
+MAX_TRACKED_UPLOADS = 256
+
+
+def receive_upload_chunk(upload, stream, length, chunk_size=65536):
+    """
+    Guarda el fragmento que llega del cliente en un fichero temporal, sin
+    tocar la base de datos. Devuelve la ruta y los bytes recibidos.
+    """
+    chunk_path = f"{upload_part_path(upload)}.{uuid.uuid4().hex}.chunk"
+    os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+    received = 0
+    with open(chunk_path, "wb") as f:
+        while received < length:
+            chunk = stream.read(min(chunk_size, length - received))
             if not chunk:
                 break
-            hash_sha256.update(chunk)
             f.write(chunk)
+            received += len(chunk)
+    return chunk_path, received
 
-    file.seek(0)
-    return hash_sha256.hexdigest()
+
+def write_upload_chunk(upload, stream, start, length, chunk_size=65536):
+    part_path = upload_part_path(upload)
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+
+    offset, hasher = _upload_hashers.pop(upload.id, (0, hashlib.sha256()))
+    track_hash = offset == start
+    written = 0
+
+    with open(part_path, "r+b" if os.path.exists(part_path) else "wb") as f:
+        f.seek(start)
+        while written < length:
+            chunk = stream.read(min(chunk_size, length - written))
+            if not chunk:
+                break
+            f.write(chunk)
+            if track_hash:
+                hasher.update(chunk)
+            written += len(chunk)
+
+    if track_hash:
+        _upload_hashers[upload.id] = (start + written, hasher)
+        while len(_upload_hashers) > MAX_TRACKED_UPLOADS:
+            _upload_hashers.popitem(last=False)
+
+    return written
+
+
+def finish_upload_hash(upload):
+    offset, hasher = _upload_hashers.pop(upload.id, (0, None))
+    if hasher is not None and offset == upload.size:
+        return hasher.hexdigest()
+
+    with open(upload_part_path(upload), "rb") as f:
+        return calculate_file_hash(f)
+
+
+def discard_upload(upload):
+    _upload_hashers.pop(upload.id, None)
+    part_path = upload_part_path(upload)
+    if os.path.isfile(part_path):
+        os.remove(part_path)
 
 
 def save_file_streaming(file, file_path, chunk_size=16384):
@@ -66,29 +215,342 @@ def save_file_streaming(file, file_path, chunk_size=16384):
     file.seek(0)
 
 
-def stream_file_response(file_path, filename, chunk_size=16384, cache_timeout=3600):
-    def generate_chunks():
+MAX_BYTE_RANGES = 16
+
+
+def bytes_response(data, filename, cache_timeout=3600, etag=None):
+    etag = etag or hashlib.sha256(data).hexdigest()
+    headers = {
+        "ETag": quote_etag(etag),
+        "Cache-Control": f"public, max-age={cache_timeout}",
+    }
+
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+
+    headers.update(
+        {
+            "Content-Disposition": f"inline; filename={filename}",
+            "Content-Length": str(len(data)),
+            "X-Content-Type-Options": "nosniff",
+        }
+    )
+    return Response(data, mimetype="application/octet-stream", headers=headers)
+
+
+def parse_byte_ranges(range_header, file_size):
+    """
+    Devuelve los rangos (inicio, fin exclusivo) ordenados y fusionados de una
+    cabecera Range. None si la cabecera no es válida y [] si no es satisfacible.
+    """
+    units, _, spec = range_header.partition("=")
+    if units.strip().lower() != "bytes" or not spec.strip():
+        return None
+
+    ranges = []
+    for part in spec.split(","):
+        first, separator, last = part.strip().partition("-")
+        if not separator:
+            return None
+        try:
+            if not first:
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                start, end = max(file_size - suffix, 0), file_size
+            else:
+                start = int(first)
+                end = int(last) + 1 if last else file_size
+                if start < 0 or (last and end <= start):
+                    return None
+                end = min(end, file_size)
+        except ValueError:
+            return None
+
+        if start < end:
+            ranges.append((start, end))
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def stream_file_response(
+    file_path,
+    filename,
+    chunk_size=16384,
+    cache_timeout=3600,
+    etag=None,
+    immutable=False,
+    precompressed=False,
+    cached=False,
+):
+    def generate_chunks(start, end):
+        if buffer is not None:
+            for offset in range(start, end, chunk_size):
+                yield buffer[offset : min(offset + chunk_size, end)]
+            return
+
         try:
             with open(file_path, "rb") as f:
-                while True:
-                    chunk = f.read(chunk_size)
+                f.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    # Con gevent la lectura de disco va a un hilo del sistema
+                    chunk = run_blocking(f.read, min(chunk_size, remaining))
                     if not chunk:
                         break
+                    remaining -= len(chunk)
                     yield chunk
-        except Exception as e:
-            print.error(f"Error streaming file {file_path}: {str(e)}")
+        except Exception:
+            logger.exception("Error al enviar el fichero %s", file_path)
             return
 
-    file_size = os.path.getsize(file_path)
+    def generate_multipart(ranges, boundary):
+        for start, end in ranges:
+            yield part_header(start, end, boundary)
+            yield from generate_chunks(start, end)
+            yield b"\r\n"
+        yield f"--{boundary}--\r\n".encode()
 
-    return Response(
-        generate_chunks(),
-        mimetype="application/octet-stream",
-        headers={
+    def part_header(start, end, boundary):
+        return (
+            f"--{boundary}\r\n"
+            "Content-Type: application/octet-stream\r\n"
+            f"Content-Range: bytes {start}-{end - 1}/{file_size}\r\n\r\n"
+        ).encode()
+
+    # El generador se consume fuera del contexto de la aplicación
+    logger = current_app.logger
+    content_encoding = None
+    if precompressed and Config.FILE_SERVING_BACKEND != "accel":
+        file_path, content_encoding = select_variant(
+            file_path, request.accept_encodings
+        )
+
+    file_stat = os.stat(file_path)
+    file_size = file_stat.st_size
+    modified = int(file_stat.st_mtime)
+    # Las ROMs usan su SHA-256 como ETag; el resto, tamaño y fecha como nginx
+    etag = etag or f"{file_size:x}-{modified:x}"
+    if content_encoding:
+        etag = f"{etag}-{content_encoding}"
+
+    headers = {
+        "ETag": quote_etag(etag),
+        "Last-Modified": http_date(modified),
+        "Cache-Control": f"public, max-age={cache_timeout}"
+        + (", immutable" if immutable else ""),
+    }
+    if precompressed:
+        headers["Vary"] = "Accept-Encoding"
+    if content_encoding:
+        headers["Content-Encoding"] = content_encoding
+
+    if request.if_none_match:
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers=headers)
+    elif (
+        request.if_modified_since and modified <= request.if_modified_since.timestamp()
+    ):
+        return Response(status=304, headers=headers)
+
+    # Con sendfile y accel el núcleo ya evita las copias, la caché solo ayuda
+    # cuando los bytes pasan por Python. Un 304 no la toca
+    buffer = None
+    if cached and Config.ROM_CACHE_BYTES and Config.FILE_SERVING_BACKEND == "stream":
+        buffer, hit = rom_cache.get(file_path, lambda: map_file(file_path))
+        headers["X-Cache"] = "HIT" if hit else "MISS"
+
+    headers.update(
+        {
             "Content-Disposition": f"inline; filename={filename}",
-            "Content-Length": str(file_size),
-            "Cache-Control": f"public, max-age={cache_timeout}",
             "Accept-Ranges": "bytes",
             "X-Content-Type-Options": "nosniff",
-        },
+        }
     )
+
+    ranges = None
+    range_header = request.headers.get("Range")
+    if range_header and if_range_matches(etag, modified):
+        ranges = parse_byte_ranges(range_header, file_size)
+        if ranges is not None and len(ranges) > MAX_BYTE_RANGES:
+            ranges = None
+
+    if ranges == []:
+        headers["Content-Range"] = f"bytes */{file_size}"
+        return Response(status=416, headers=headers)
+
+    # Con X-Accel-Redirect nginx envía el fichero y resuelve los rangos,
+    # Flask solo se encarga de la autorización y de las cabeceras
+    accel_path = (
+        accel_redirect_path(file_path)
+        if Config.FILE_SERVING_BACKEND == "accel"
+        else None
+    )
+    if accel_path:
+        headers["X-Accel-Redirect"] = accel_path
+        return Response(mimetype="application/octet-stream", headers=headers)
+
+    if not ranges:
+        headers["Content-Length"] = str(file_size)
+        if Config.FILE_SERVING_BACKEND == "sendfile":
+            return Response(
+                wrap_file(request.environ, open(file_path, "rb"), chunk_size),
+                mimetype="application/octet-stream",
+                headers=headers,
+                direct_passthrough=True,
+            )
+        return Response(
+            generate_chunks(0, file_size),
+            mimetype="application/octet-stream",
+            headers=headers,
+        )
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{file_size}"
+        headers["Content-Length"] = str(end - start)
+        return Response(
+            generate_chunks(start, end),
+            status=206,
+            mimetype="application/octet-stream",
+            headers=headers,
+        )
+
+    boundary = uuid.uuid4().hex
+    headers["Content-Length"] = str(
+        sum(
+            len(part_header(start, end, boundary)) + end - start + 2
+            for start, end in ranges
+        )
+        + len(f"--{boundary}--\r\n")
+    )
+    return Response(
+        generate_multipart(ranges, boundary),
+        status=206,
+        content_type=f"multipart/byteranges; boundary={boundary}",
+        headers=headers,
+    )
+
+
+def storage_file_response(
+    storage,
+    key,
+    filename,
+    chunk_size=16384,
+    cache_timeout=3600,
+    etag=None,
+    immutable=False,
+    precompressed=False,
+    cached=False,
+):
+    """
+    Envía un fichero del almacén. Los locales van por stream_file_response;
+    los de S3 redirigen a una URL firmada o, si está desactivado, se
+    retransmiten desde el bucket.
+    """
+    file_path = storage.local_path(key)
+    if file_path is not None:
+        return stream_file_response(
+            file_path,
+            filename,
+            chunk_size=chunk_size,
+            cache_timeout=cache_timeout,
+            etag=etag,
+            immutable=immutable,
+            precompressed=precompressed,
+            cached=cached,
+        )
+
+    if Config.S3_PRESIGNED_DOWNLOADS:
+        response = redirect(
+            storage.presigned_url(key, filename, Config.S3_PRESIGN_EXPIRES)
+        )
+        # La URL caduca, así que la redirección no se puede cachear
+        response.headers["Cache-Control"] = "private, no-store"
+        return response
+
+    file_size = None
+    if etag is None:
+        file_size = storage.size(key)
+        etag = f"{file_size:x}"
+    headers = {
+        "ETag": quote_etag(etag),
+        "Cache-Control": f"public, max-age={cache_timeout}"
+        + (", immutable" if immutable else ""),
+        "Content-Disposition": f"inline; filename={filename}",
+        "Accept-Ranges": "bytes",
+        "X-Content-Type-Options": "nosniff",
+    }
+
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+
+    # La caché se consulta después del 304 para no leer el fichero sin enviarlo
+    buffer = None
+    if cached and Config.ROM_CACHE_BYTES:
+        buffer, hit = rom_cache.get(key, lambda: storage.read(key))
+        file_size = len(buffer)
+    elif file_size is None:
+        file_size = storage.size(key)
+
+    start, end = 0, file_size
+    status = 200
+    range_header = request.headers.get("Range")
+    if range_header and if_range_matches(etag, None):
+        ranges = parse_byte_ranges(range_header, file_size)
+        if ranges == []:
+            headers["Content-Range"] = f"bytes */{file_size}"
+            return Response(status=416, headers=headers)
+        # Desde S3 solo se retransmite un rango; con varios va el fichero entero
+        if ranges and len(ranges) == 1:
+            start, end = ranges[0]
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{file_size}"
+
+    headers["Content-Length"] = str(end - start)
+    if buffer is not None:
+        headers["X-Cache"] = "HIT" if hit else "MISS"
+        return Response(
+            (
+                buffer[offset : min(offset + chunk_size, end)]
+                for offset in range(start, end, chunk_size)
+            ),
+            status=status,
+            mimetype="application/octet-stream",
+            headers=headers,
+        )
+    return Response(
+        storage.read_range(key, start, end, chunk_size),
+        status=status,
+        mimetype="application/octet-stream",
+        headers=headers,
+    )
+
+
+def accel_redirect_path(file_path):
+    real_path = os.path.realpath(file_path)
+    for folder, location in Config.ACCEL_REDIRECT_LOCATIONS.items():
+        relative = os.path.relpath(real_path, os.path.realpath(folder))
+        if not relative.startswith(os.pardir):
+            return location + quote(relative.replace(os.sep, "/"))
+    return None
+
+
+def if_range_matches(etag, modified):
+    if_range_header = request.headers.get("If-Range")
+    if not if_range_header:
+        return True
+
+    # If-Range exige comparación fuerte, un ETag débil nunca coincide
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return not if_range_header.lstrip().startswith("W/") and if_range.etag == etag
+    if if_range.date is not None:
+        return int(if_range.date.timestamp()) == modified
+    return False
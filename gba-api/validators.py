@@ -1,5 +1,7 @@
 import string
 
+from utils import allowed_file
+
 
 def validate_password(password):
     if len(password) < 8:
@@ -13,3 +15,31 @@ def validate_password(password):
     if not any(char in string.punctuation for char in password):
         return "La contraseña debe incluir al menos un carácter especial."
     return None
+
+
+def validate_file_entry(entry):
+    if not isinstance(entry, dict):
+        return "Formato de fichero inválido."
+    name = entry.get("name")
+    file_hash = entry.get("hash")
+    size = entry.get("size")
+    if not isinstance(name, str) or not name or len(name) > 256:
+        return "Nombre de fichero inválido."
+    if (
+        not isinstance(file_hash, str)
+        or len(file_hash) != 64
+        or any(char not in string.hexdigits for char in file_hash)
+    ):
+        return "Hash de fichero inválido."
+    if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+        return "Tamaño de fichero inválido."
+    return None
+
+
+def validate_rom_entry(entry):
+    entry_error = validate_file_entry(entry)
+    if entry_error:
+        return entry_error
+    if not allowed_file(entry["name"]):
+        return "Nombre de ROM inválido."
+    return None
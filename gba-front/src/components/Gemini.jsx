@@ -7,6 +7,7 @@ function Gemini() {
     const [content, setContent] = useState('');
     const [isLoading, setIsLoading] = useState(false);
     const [conversation, setConversation] = useState([]);
+    const [conversationId, setConversationId] = useState(null);
     const [isOpen, setIsOpen] = useState(false);
     const panelRef = useRef(null);
     const textAreaRef = useRef(null);
@@ -46,20 +47,46 @@ function Gemini() {
         setConversation(newConversation);
 
         try {
-            const result = await fetch('/gemini', {
+            // La respuesta llega por SSE a medida que el modelo la genera; el
+            // historial lo guarda el servidor, solo se envía el mensaje nuevo
+            const result = await fetch('/gemini/stream', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({
                     content: userMessage,
-                    history: conversation
+                    conversation_id: conversationId
                 })
             });
 
             if (!result.ok) throw new Error('Error en la respuesta');
 
-            const text = await result.json();
-
-            setConversation([...newConversation, { type: 'ai', content: text.response }]);
+            const reader = result.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let reply = '';
+
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+
+                const events = buffer.split('\n\n');
+                buffer = events.pop();
+                for (const rawEvent of events) {
+                    const eventName = rawEvent.match(/^event: (.*)$/m)?.[1];
+                    const eventData = JSON.parse(rawEvent.match(/^data: (.*)$/m)?.[1] || '{}');
+
+                    if (eventName === 'conversation') {
+                        setConversationId(eventData.conversation_id);
+                    } else if (eventName === 'message') {
+                        reply += eventData.text;
+                        setIsLoading(false);
+                        setConversation([...newConversation, { type: 'ai', content: reply }]);
+                    } else if (eventName === 'error') {
+                        throw new Error(eventData.error);
+                    }
+                }
+            }
         } catch (error) {
             console.error('Error:', error);
             setConversation([...newConversation, { type: 'ai', content: 'Error: No se pudo obtener respuesta de la IA.' }]);
@@ -77,6 +104,7 @@ function Gemini() {
 
     const clearConversation = () => {
         setConversation([]);
+        setConversationId(null);
     }
 
     return (
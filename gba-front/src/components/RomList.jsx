@@ -31,22 +31,96 @@ function RomList({ onSuccess }) {
         }
     }
 
+    const toHex = (buffer) => Array.from(new Uint8Array(buffer))
+        .map(byte => byte.toString(16).padStart(2, '0'))
+        .join('');
+
+    const hashBlob = async (blob) => {
+        return toHex(await crypto.subtle.digest('SHA-256', await blob.arrayBuffer()));
+    }
+
+    // Prueba de que se tiene la ROM: HMAC de los rangos que pide el servidor
+    const proveBlob = async (blob, { nonce, ranges }) => {
+        const keyBytes = new Uint8Array(nonce.match(/../g).map(byte => parseInt(byte, 16)));
+        const key = await crypto.subtle.importKey('raw', keyBytes, { name: 'HMAC', hash: 'SHA-256' }, false, ['sign']);
+        const data = await new Blob(ranges.map(([start, end]) => blob.slice(start, end))).arrayBuffer();
+        return toHex(await crypto.subtle.sign('HMAC', key, data));
+    }
+
     const handleSubmit = async (e) => {
         e.preventDefault();
         setError('');
         setIsLoading(true);
 
         try {
-            const formData = new FormData();
+            const headers = {
+                'Content-Type': 'application/json',
+                'X-CSRF-TOKEN': getCookie('csrf_access_token'),
+            };
+
+            // Primero se pregunta al servidor qué ROMs ya tiene para no volver a enviarlas
+            const romEntries = [];
             for (const rom of selectedRoms) {
                 const romBlob = await getRomData(rom);
-                formData.append('roms', romBlob, rom);
+                romEntries.push({ name: rom, size: romBlob.size, hash: await hashBlob(romBlob), blob: romBlob });
+            }
+            const romsMetadata = romEntries.map(({ name, size, hash }) => ({ name, size, hash }));
+
+            const checkResponse = await fetch('/api/checkroms', {
+                method: 'POST',
+                credentials: 'include',
+                headers,
+                body: JSON.stringify({ roms: romsMetadata }),
+            });
+
+            if (!checkResponse.ok) {
+                throw new Error('Inicia sesión para subir las ROMs');
+            }
+
+            // Las ROMs que el usuario no tiene se intentan vincular respondiendo al
+            // reto; las que el servidor no tiene o no lo superan se suben
+            const { roms: romStatuses } = await checkResponse.json();
+            const challenges = new Map(romStatuses.filter(r => r.status === 'challenge').map(r => [r.hash, r.challenge]));
+            let missingHashes = new Set();
+
+            if (challenges.size > 0) {
+                const attachEntries = [];
+                for (const { name, size, hash, blob } of romEntries) {
+                    const challenge = challenges.get(hash);
+                    if (challenge) {
+                        attachEntries.push({ name, size, hash, token: challenge.token, proof: await proveBlob(blob, challenge) });
+                    }
+                }
+
+                const attachResponse = await fetch('/api/attachroms', {
+                    method: 'POST',
+                    credentials: 'include',
+                    headers,
+                    body: JSON.stringify({ roms: attachEntries }),
+                });
+
+                if (!attachResponse.ok) {
+                    throw new Error('No se han podido vincular las ROMs');
+                }
+
+                const { missing } = await attachResponse.json();
+                missingHashes = new Set(missing);
+            }
+
+            const formData = new FormData();
+            let pendingFiles = 0;
+            for (const { name: rom, hash, blob: romBlob } of romEntries) {
+                if (missingHashes.has(hash)) {
+                    formData.append('roms', romBlob, rom);
+                    pendingFiles++;
+                }
 
                 if (includeSaves) {
                     try {
                         const save = rom.replace(/\.[^.]+$/, '.sav');
                         const saveBlob = await getSaveData(save);
                         formData.append('saves', saveBlob, save);
+                        pendingFiles++;
                     } catch (error) {
                         console.log('No se encontró save para:', rom, error.message);
                     }
@@ -55,17 +129,19 @@ function RomList({ onSuccess }) {
 
             formData.append('include_saves', includeSaves);
 
-            const response = await fetch('/api/uploadroms', {
-                method: 'POST',
-                credentials: 'include',
-                headers: {
-                    'X-CSRF-TOKEN': getCookie('csrf_access_token'),
-                },
-                body: formData,
-            })
+            if (pendingFiles > 0) {
+                const response = await fetch('/api/uploadroms', {
+                    method: 'POST',
+                    credentials: 'include',
+                    headers: {
+                        'X-CSRF-TOKEN': getCookie('csrf_access_token'),
+                    },
+                    body: formData,
+                })
 
-            if (!response.ok) {
-                throw new Error('Inicia sesión para subir las ROMs');
+                if (!response.ok) {
+                    throw new Error('Inicia sesión para subir las ROMs');
+                }
             }
 
             setSuccess(true);
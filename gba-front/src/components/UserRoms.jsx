@@ -4,6 +4,7 @@ import { CloudDownload, Play, RefreshCw, Save, Trash2, TriangleAlert } from 'luc
 
 function UserRoms({ onSuccess }) {
     const [roms, setRoms] = useState([]);
+    const [nextCursor, setNextCursor] = useState(null);
     const [loading, setLoading] = useState(true);
     const [isLoading, setIsLoading] = useState(false);
     const [error, setError] = useState('');
@@ -16,10 +17,11 @@ function UserRoms({ onSuccess }) {
         loadRoms();
     }, []);
 
-    const loadRoms = async () => {
-        setLoading(true);
+    const loadRoms = async (cursor = null) => {
+        setLoading(!cursor);
         try {
-            const response = await fetch('/api/loadroms', {
+            const url = cursor ? `/api/loadroms?cursor=${encodeURIComponent(cursor)}` : '/api/loadroms';
+            const response = await fetch(url, {
                 credentials: 'include'
             });
 
@@ -28,7 +30,8 @@ function UserRoms({ onSuccess }) {
             }
 
             const data = await response.json();
-            setRoms(data);
+            setRoms((prev) => (cursor ? [...prev, ...data] : data));
+            setNextCursor(response.headers.get('X-Next-Cursor'));
         } catch (error) {
             console.error('Error loading roms:', error);
         } finally {
@@ -182,7 +185,7 @@ function UserRoms({ onSuccess }) {
                 <button
                     type="button"
                     className="p-1 text-gray-400 hover:text-white transition-colors"
-                    onClick={loadRoms}
+                    onClick={() => loadRoms()}
                     title="Recargar lista"
                 >
                     <RefreshCw className="h-5 w-5" />
@@ -292,6 +295,17 @@ function UserRoms({ onSuccess }) {
                                     </div>
                                 </li>
                             ))}
+                            {nextCursor && (
+                                <li>
+                                    <button
+                                        type="button"
+                                        className="w-full p-2 text-sm text-purple-400 hover:text-white transition-colors"
+                                        onClick={() => loadRoms(nextCursor)}
+                                    >
+                                        Cargar más
+                                    </button>
+                                </li>
+                            )}
                         </ul>
                     ) : (
                         <div className="text-center py-8 text-gray-400">